@@ -1,18 +1,12 @@
 # coding: utf-8
-from urllib import request
 from urllib import parse
-import urllib3
-import requests
 import threading
 import os
-import hashlib
 import time
 import sys
 # 在手机上跑 Pythonista 引入 clipboard 比较方便
 # import clipboard
-
-# 忽略警告
-urllib3.disable_warnings()
+# urllib.request、requests、hashlib 都在用到时才导入，--help 之类不必等它们
 
 class D1wnloader:
     def __init__(self, url, download_dir="./", blocks_num=5, max_retry_times=5):
@@ -48,6 +42,7 @@ class D1wnloader:
                         (self.url, self.download_dir + self.filename, readable_size))
 
     def get_size(self):
+        from urllib import request
         with request.urlopen(self.url) as req:
             content_length = req.headers["Content-Length"]
             return int(content_length)
@@ -89,6 +84,8 @@ class D1wnloader:
             sys.stdout.write("I tried, now, tired\n")
 
     def download(self, start, end, event_num):
+        import requests
+        requests.packages.urllib3.disable_warnings()  # 忽略警告
         cache_filename = self.cache_dir + self.filename + ".part_" + str(event_num) + "_" + str(self.blocks_num)
         total_size = end - start + 1
         if os.path.exists(cache_filename):
@@ -161,13 +158,26 @@ class D1wnloader:
     def sha256(self):
         full_filename = self.download_dir+self.filename
         if os.path.exists(full_filename):
+            import hashlib
+            h = hashlib.sha256()
             with open(full_filename, "rb") as f:
-                return hashlib.sha256(f.read()).hexdigest()
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):  # 分块读，大文件不必整个装进内存
+                    h.update(chunk)
+            return h.hexdigest()
         else:
             return "File not found."
 
 
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="多线程分块下载（D2wnloader 的前身）")
+    parser.add_argument("urls", nargs="+", metavar="URL")
+    parser.add_argument("-d", "--dir", default="./", help="下载到哪里，以 / 结尾")
+    parser.add_argument("-n", "--blocks", type=int, default=5, help="分几块")
+    args = parser.parse_args(argv)
+    for url in args.urls:
+        D1wnloader(url, download_dir=args.dir, blocks_num=args.blocks).start()
+
+
 if __name__ == "__main__":
-    url = "https://qd.myapp.com/myapp/qqteam/pcqq/QQ9.0.8_3.exe"
-    d = D1wnloader(url)
-    d.start()
+    main()
@@ -1,20 +1,739 @@
 # -*- coding: utf-8 -*-
 import threading, time
+import io
 from urllib import parse
-import requests
 import os
 import sys
-import glob
-import hashlib
-import ssl
+import json
+import heapq
+import bisect
+import collections
+import struct
+import zlib
+import socket
+import re
 
-# 忽略 https 警告
-ssl._create_default_https_context = ssl._create_unverified_context
-requests.packages.urllib3.disable_warnings()
+# requests、hashlib、glob、ssl、http.server 都在用到的地方才导入：命令行一次次跑很短的下载时，光导入 requests（0.1 秒左右）
+# 就比下载本身还慢，而 --help、参数写错、读批量文件这些时候根本用不着它们
+
+
+def import_requests():
+    """要发请求时才导入 requests，顺便忽略 https 警告"""
+    import ssl
+    import requests
+    ssl._create_default_https_context = ssl._create_unverified_context
+    requests.packages.urllib3.disable_warnings()
+    return requests
+
+
+def pwrite(fd, data, offset):
+    """按偏移写入，多个 worker 共用同一个 fd 也不会互相干扰"""
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    else:  # Windows 没有 pwrite，只能加锁 seek 再 write
+        with _pwrite_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+_pwrite_lock = threading.Lock()
+
+
+class IntervalSet:
+    """AAEK：尚未开垦的区间集合，两头包含，相邻或重叠的区间自动合并。
+    起点保存在有序列表里用 bisect 定位：find 是 O(log n)；add、discard 定位是 O(log n)，
+    但列表中间插入删除要 memmove，所以是 O(n)（C 层面的搬运，块数在几千以内可以忽略）。
+    take 从头取 k 块，一次切片删除，O(n)；take_small 要逐块看大小，是一遍 Python 层面的 O(n) 扫描。"""
+
+    def __init__(self, ranges=()):
+        self.__starts = []  # 有序的起点
+        self.__ends = {}  # start -> end
+        self.__lock = threading.RLock()
+        self.total = 0  # 覆盖的字节数
+        for start, end in ranges:
+            self.add(start, end)
+
+    def __len__(self):
+        return len(self.__starts)
+
+    def __iter__(self):
+        with self.__lock:
+            return iter([(s, self.__ends[s]) for s in self.__starts])
+
+    def __repr__(self):
+        return f"IntervalSet({list(self)})"
+
+    def __insert(self, start, end):
+        bisect.insort(self.__starts, start)
+        self.__ends[start] = end
+        self.total += end - start + 1
+
+    def __remove(self, index):
+        start = self.__starts.pop(index)
+        end = self.__ends.pop(start)
+        self.total -= end - start + 1
+        return start, end
+
+    def add(self, start, end):
+        """交回一段，与左右相邻的合并"""
+        if start > end:
+            return
+        with self.__lock:
+            i = bisect.bisect_left(self.__starts, start)
+            if i > 0 and self.__ends[self.__starts[i - 1]] >= start - 1:
+                s, e = self.__remove(i - 1)
+                i -= 1
+                start, end = min(s, start), max(e, end)
+            while i < len(self.__starts) and self.__starts[i] <= end + 1:
+                _, e = self.__remove(i)
+                end = max(e, end)
+            self.__insert(start, end)
+
+    def discard(self, start, end):
+        """从集合里扣掉 [start, end]（比如这部分已经从别处拿到了）"""
+        with self.__lock:
+            i = bisect.bisect_right(self.__starts, start) - 1
+            i = max(i, 0)
+            while i < len(self.__starts) and self.__starts[i] <= end:
+                s, e = self.__starts[i], self.__ends[self.__starts[i]]
+                if e < start:
+                    i += 1
+                    continue
+                self.__remove(i)
+                if s < start:
+                    self.__insert(s, start - 1)
+                    i += 1
+                if e > end:
+                    self.__insert(end + 1, e)
+                    break
+
+    def take_small(self, n, max_size):
+        """按顺序取走至多 n 块不超过 max_size 的小块。扫一遍、重建一次起点列表，不逐块 pop"""
+        with self.__lock:
+            task, keep = [], []
+            for i, start in enumerate(self.__starts):
+                if len(task) == n:
+                    keep += self.__starts[i:]
+                    break
+                end = self.__ends[start]
+                if end - start + 1 <= max_size:
+                    task.append((start, end))
+                else:
+                    keep.append(start)
+            for start, end in task:
+                del self.__ends[start]
+                self.total -= end - start + 1
+            self.__starts = keep
+            return task
+
+    def find(self, x):
+        """包含 x 的那一块，没有则返回 None"""
+        with self.__lock:
+            i = bisect.bisect_right(self.__starts, x) - 1
+            if i >= 0 and self.__ends[self.__starts[i]] >= x:
+                return self.__starts[i], self.__ends[self.__starts[i]]
+            return None
+
+    def pop_first(self):
+        with self.__lock:
+            return self.__remove(0) if self.__starts else None
+
+    def take(self, n, minimum_size=1024 * 1024):
+        """取走 n 块。不够就把取到的块里最大的一分为二（用一个临时的大根堆找），小于 minimum_size 就不再分割了。"""
+        with self.__lock:
+            starts = self.__starts[:n]
+            del self.__starts[:n]  # 一次切片删除，不逐块 pop(0)
+            task = [(s, self.__ends.pop(s)) for s in starts]
+            self.total -= sum(e - s + 1 for s, e in task)
+        if not task:
+            return task
+        heap = [(s - e - 1, s, e) for s, e in task]
+        heapq.heapify(heap)
+        while len(heap) < n:
+            _, start, end = heap[0]
+            halfsize = (end - start + 1) // 2
+            if halfsize < minimum_size:
+                break
+            heapq.heapreplace(heap, (-(halfsize + 1), start, start + halfsize))
+            heapq.heappush(heap, (start + halfsize + 1 - end - 1, start + halfsize + 1, end))
+        return sorted([(s, e) for _, s, e in heap])
+
+
+class Journal:
+    """断点续传日志：只追加，攒够一批（或隔一段时间）才 fsync 一次。
+    文件头记录文件大小和 ETag，之后每条记录是 (start, end, crc32)，同一个 start 以最后一条为准。
+    缓存模式下 start 就是缓存文件名里的起始字节；预分配模式下就是写入的位置。
+    崩溃时最多丢掉最后一批没 fsync 的记录，对应的部分重新下载即可；写了一半的记录靠 crc 识别后丢弃。"""
+    HEADER = struct.Struct("<4sQH")  # magic, size, len(etag)
+    RECORD = struct.Struct("<QQI")  # start, end, crc32
+    MAGIC = b"D2LJ"
+
+    def __init__(self, path, size, etag="", before_flush=None, batch=64, interval=1.0):
+        self.path = path
+        self.size = size
+        self.etag = etag or ""
+        self.before_flush = before_flush  # fsync 日志之前先让数据落盘，保证日志里有的数据一定在盘上
+        self.batch = batch
+        self.interval = interval
+        self.entries = {}  # start -> end
+        self.done_bytes = 0  # entries 覆盖的字节数（按记录累加，缓存模式下的重叠部分会重复计算）
+        self.__pending = []
+        self.__records = 0  # 文件里的记录条数，多出 entries 太多就压缩一次
+        self.__last_flush = time.time()
+        self.__lock = threading.Lock()
+        self.stale = False  # 日志在，但大小或 ETag 对不上（远端文件换了），旧进度连同数据都作废
+        self.resumed = self.__load()
+        self.__rewrite()
+
+    def __load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return False
+        self.stale = True  # 下面对不上就都算作废
+        if len(data) < self.HEADER.size:
+            return False
+        magic, size, etag_len = self.HEADER.unpack_from(data)
+        offset = self.HEADER.size + etag_len
+        etag = data[self.HEADER.size:offset].decode("utf-8", "replace")
+        if magic != self.MAGIC or size != self.size or etag != self.etag:
+            return False  # 远端文件变了，旧进度作废
+        self.stale = False
+        while offset + self.RECORD.size <= len(data):
+            start, end, crc = self.RECORD.unpack_from(data, offset)
+            if zlib.crc32(data[offset:offset + 16]) != crc:
+                break  # 崩溃时写了一半的记录
+            self.__apply(start, end)
+            offset += self.RECORD.size
+        return True
+
+    def __apply(self, start, end):
+        old_end = self.entries.get(start, start - 1)
+        self.entries[start] = end
+        self.done_bytes += end - old_end
+
+    def __pack(self, start, end):
+        body = struct.pack("<QQ", start, end)
+        return body + struct.pack("<I", zlib.crc32(body))
+
+    def __rewrite(self):
+        """压缩：每个 start 只留一条，写临时文件再原子替换"""
+        etag = self.etag.encode("utf-8")
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.size, len(etag)) + etag)
+            f.write(b"".join(self.__pack(s, e) for s, e in self.entries.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+        self.__records = len(self.entries)
+        self.__file = open(self.path, "ab")
+
+    def record(self, start, end):
+        """记录 [start, end] 已写好。攒批写入，不保证立即落盘。"""
+        if end < start:
+            return
+        with self.__lock:
+            if self.entries.get(start) == end:
+                return
+            self.__apply(start, end)
+            self.__pending.append(self.__pack(start, end))
+            need_flush = len(self.__pending) >= self.batch or time.time() - self.__last_flush >= self.interval
+        if need_flush:
+            self.flush()
+
+    def flush(self):
+        with self.__lock:
+            self.__last_flush = time.time()
+            if not self.__pending or self.__file is None:
+                return
+            if self.before_flush is not None:
+                self.before_flush()
+            self.__file.write(b"".join(self.__pending))
+            self.__file.flush()
+            os.fsync(self.__file.fileno())
+            self.__records += len(self.__pending)
+            self.__pending = []
+            if self.__records > 2 * len(self.entries) + 1024:
+                self.__file.close()
+                self.__rewrite()
+
+    def ranges(self):
+        with self.__lock:  # 别的线程可能正在 record
+            return sorted(self.entries.items())
+
+    def cut(self, start, end):
+        """从进度里划掉 [start, end]（核对没通过，要重下）。跨过 end 的记录，后半截改记在 end + 1 名下，
+        缓存模式下调用方要先把这部分数据挪到以 end + 1 命名的缓存文件里。改完直接压缩重写"""
+        with self.__lock:
+            for s, e in list(self.entries.items()):
+                if s > end or e < start:
+                    continue
+                del self.entries[s]
+                self.done_bytes -= e - s + 1
+                if s < start:
+                    self.__apply(s, start - 1)
+                if e > end and self.entries.get(end + 1, end) < e:
+                    self.__apply(end + 1, e)
+            if self.before_flush is not None:
+                self.before_flush()  # 攒着的记录也在 entries 里，一起写进去
+            self.__pending = []
+            self.__file.close()
+            self.__rewrite()
+
+    def reset(self):
+        """清空进度，从头开始"""
+        with self.__lock:
+            self.entries = {}
+            self.done_bytes = 0
+            self.__pending = []
+            self.__file.close()
+            self.__rewrite()
+
+    def close(self):
+        self.flush()
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ProbeCache:
+    """探测结果的小缓存（一个 JSON 文件）：大小、是否支持 Range、ETag/Last-Modified、跳转之后的地址。
+    同一个 URL 在 ttl 秒内再下载或续传时直接拿来用，不再探测，也不再走一遍跳转。"""
+    TTL = 3600
+    __lock = threading.Lock()  # 同一进程里的几个下载共用一个文件
+
+    def __init__(self, path, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def __load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __save(self, records):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(records, f)
+        os.replace(tmp, self.path)
+
+    def get(self, url):
+        """没过期的记录，没有返回 None"""
+        if self.ttl <= 0:
+            return None
+        with self.__lock:
+            record = self.__load().get(url)
+        if record is None or record.get("expires", 0) < time.time():
+            return None
+        return record
+
+    def put(self, url, record):
+        if self.ttl <= 0:
+            return
+        with self.__lock:
+            now = time.time()
+            records = {k: v for k, v in self.__load().items() if v.get("expires", 0) >= now}  # 顺便清掉过期的
+            records[url] = dict(record, expires=now + self.ttl)
+            self.__save(records)
+
+    def discard(self, url):
+        with self.__lock:
+            records = self.__load()
+            if records.pop(url, None) is not None:
+                self.__save(records)
+
+
+# 内容定义分块（增量下载用）：每个字节查表映射成一位，某个 16 位的样式出现处切一刀。
+# 切点只由附近的内容决定，插入、删除只影响一两块；translate 和 find 都在 C 里跑，比逐字节的滚动哈希快得多
+# 映射表是 bytes(hashlib.sha256(bytes([b])).digest()[0] & 1 for b in range(256))，写死了省得导入时算
+CHUNK_BITS = bytes.fromhex(
+    "00010100010101000001010101010100010000010101000101000001010100010001000101010100000000010001010001010000010101010001010100000000"
+    "01010101010100010000010000000000000000010000000001000100010100000100000000010101000000000000010100000100010100000101010001010000"
+    "00010100000000010101010001010000000101010101000001010001000101010100000100010001000000000000010000000101010100010100000100000101"
+    "00010100010001010001010001000100000101000001000101010101010101000100000100010000000000000101000101000000000100000101000000000000"
+)
+CHUNK_ANCHOR = bytes([1, 0, 1, 1, 0, 0, 1, 0, 1, 1, 1, 0, 0, 0, 1, 1])  # 平均约 64 KB 出现一次
+CHUNK_MIN = 16 * 1024
+CHUNK_MAX = 256 * 1024
+
+
+def iter_chunks(f, read_size=16 * 1024 * 1024):
+    """把文件对象 f 从当前位置切成内容定义的块，逐块给出 bytes"""
+    buffer, bits, pos = b"", b"", 0
+    eof = False
+    while True:
+        while not eof and len(buffer) - pos < CHUNK_MAX:
+            data = f.read(read_size)
+            eof = not data
+            buffer = buffer[pos:] + data
+            bits = bits[pos:] + data.translate(CHUNK_BITS)
+            pos = 0
+        if pos >= len(buffer):
+            return
+        limit = min(pos + CHUNK_MAX, len(buffer))
+        cut = limit
+        if limit - pos > CHUNK_MIN:
+            i = bits.find(CHUNK_ANCHOR, pos + CHUNK_MIN - len(CHUNK_ANCHOR), limit - len(CHUNK_ANCHOR) + 1)
+            if i >= 0:
+                cut = i + len(CHUNK_ANCHOR)
+        yield buffer[pos:cut]
+        pos = cut
+
+
+def make_manifest(path, algorithm="sha256"):
+    """给本地文件生成块清单，和文件一起发布（存成 JSON）。下载时用 D2wnloader(url, manifest=清单的 URL 或路径)。
+    {"version": 1, "size": 文件大小, "hash": 算法, "chunks": [[长度, 摘要], ...]}"""
+    import hashlib
+    chunks = []
+    with open(path, "rb") as f:
+        for data in iter_chunks(f):
+            chunks.append([len(data), hashlib.new(algorithm, data).hexdigest()])
+    return {"version": 1, "size": sum(length for length, _ in chunks), "hash": algorithm, "chunks": chunks}
+
+
+class ChunkIndex:
+    """本地块索引（一个 JSON 文件）：以前下过（或指定的）文件由哪些块组成。
+    文件大小或修改时间变了的记录作废；找到的块拷贝时还会再核对一次摘要。"""
+    __lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+
+    def __load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def __save(self, records):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(records, f)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def __stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def add(self, path, chunks, algorithm):
+        """登记 path 由 chunks（[[长度, 摘要], ...]）组成"""
+        path = os.path.abspath(path)
+        stamp = self.__stamp(path)
+        if stamp is None:
+            return
+        with self.__lock:
+            records = {k: v for k, v in self.__load().items() if self.__stamp(k) == v["stamp"]}  # 顺便清掉作废的
+            records[path] = {"stamp": stamp, "hash": algorithm, "chunks": chunks}
+            self.__save(records)
+
+    def has(self, path, algorithm):
+        path = os.path.abspath(path)
+        with self.__lock:
+            record = self.__load().get(path)
+        return record is not None and record["hash"] == algorithm and record["stamp"] == self.__stamp(path)
+
+    def index_file(self, path, algorithm):
+        """切块、算摘要、登记"""
+        self.add(path, make_manifest(path, algorithm)["chunks"], algorithm)
+
+    def rename(self, old, new):
+        """文件挪了位置（内容没变），记录跟着走"""
+        old, new = os.path.abspath(old), os.path.abspath(new)
+        with self.__lock:
+            records = self.__load()
+            record = records.pop(old, None)
+            if record is None:
+                return
+            if self.__stamp(new) is not None:
+                records[new] = dict(record, stamp=self.__stamp(new))
+            self.__save(records)
+
+    def lookup(self, algorithm):
+        """{摘要: (文件, 偏移, 长度)}，只含还有效的记录"""
+        with self.__lock:
+            records = self.__load()
+        found = {}
+        for path, record in records.items():
+            if record["hash"] != algorithm or self.__stamp(path) != record["stamp"]:
+                continue
+            offset = 0
+            for length, digest in record["chunks"]:
+                found.setdefault(digest, (path, offset, length))
+                offset += length
+        return found
+
+
+class FrontierHasher:
+    """边下边算摘要。只能按顺序喂给 hashlib，所以维护一个前沿 frontier：
+    - 刚好接在前沿的数据立即计算；
+    - 跑到前面的数据先存在内存里（不超过 max_buffer），前沿追上来时接着算；
+    - 内存放不下的只记下位置，前沿追上来时用 reader 从盘上读回来（缓存模式没有 reader，留给 __sew 边拼边算）。
+    同一时刻只有一个线程在算（拿着接力棒），读盘和计算都不占锁，别的 worker 喂数据不会被卡住。"""
+
+    def __init__(self, algorithms, size, reader=None, max_buffer=16 * 1024 * 1024):
+        self.algorithms = tuple(algorithms)
+        self.size = size
+        self.reader = reader  # reader(offset, n) -> bytes
+        self.max_buffer = max_buffer
+        self.frontier = 0
+        import hashlib
+        self.__hashes = [hashlib.new(name) for name in self.algorithms]
+        self.__pending = {}  # offset -> bytes，前沿之后、还在内存里的数据
+        self.__buffered = 0
+        self.written = IntervalSet()  # 已经写到盘上的部分
+        self.__busy = False  # 接力棒
+        self.__lock = threading.Lock()
+        self.invalid = False  # 坏数据已经算进去了，只能下完后整个重算
+
+    def feed(self, offset, data):
+        """data 已经写到了 offset 处"""
+        if not data or self.invalid:
+            return
+        end = offset + len(data)
+        with self.__lock:
+            if self.reader is not None:
+                self.written.add(offset, end - 1)
+            if end <= self.frontier:
+                return
+            if self.__busy or offset > self.frontier:
+                if (offset >= self.frontier and offset not in self.__pending
+                        and self.__buffered + len(data) <= self.max_buffer):
+                    self.__pending[offset] = bytes(data)
+                    self.__buffered += len(data)
+                return
+            self.__busy = True
+            data = data[self.frontier - offset:]
+        self.__run(data)
+
+    def drain(self):
+        """前沿能追多远就追多远，比如组装前把盘上剩下的都算完"""
+        with self.__lock:
+            if self.__busy:
+                return
+            self.__busy = True
+        self.__run(b"")
+
+    def __run(self, data):
+        while True:
+            for h in self.__hashes:
+                h.update(data)
+            with self.__lock:
+                self.frontier += len(data)
+                data = self.__pending.pop(self.frontier, None)
+                if data is not None:
+                    self.__buffered -= len(data)
+                    continue
+                if self.__buffered and self.__buffered + 1024 * 1024 > self.max_buffer:
+                    # 快满了，把前沿后面已经过时的清掉
+                    for offset in [o for o, d in self.__pending.items() if o + len(d) <= self.frontier]:
+                        self.__buffered -= len(self.__pending.pop(offset))
+                block = self.written.find(self.frontier) if self.reader is not None else None
+                if block is None:
+                    self.__busy = False
+                    return
+                offset, n = self.frontier, min(block[1] - self.frontier + 1, 1024 * 1024)
+            data = self.reader(offset, n)
+            if not data:
+                with self.__lock:
+                    self.__busy = False
+                return
+
+    def forget(self, start, end):
+        """[start, end] 写进来的是坏数据，会重下。前沿还没到的话丢掉它，等新数据；已经算进去了只能作废"""
+        with self.__lock:
+            if self.__busy or self.frontier > start:
+                self.invalid = True
+                return
+            for offset in [o for o, d in self.__pending.items() if o <= end and o + len(d) > start]:
+                self.__buffered -= len(self.__pending.pop(offset))
+            self.written.discard(start, end)
+
+    def hexdigests(self):
+        """全部算完才返回 {算法: 摘要}，否则 None"""
+        with self.__lock:
+            if self.frontier < self.size or self.invalid:
+                return None
+            return {name: h.hexdigest() for name, h in zip(self.algorithms, self.__hashes)}
+
+
+class Metrics:
+    """计数器、直方图和事件，几个下载可以共用一个（标签里带 file）。
+    只在探测、worker 开始和结束、卡住、组装这些时候记一笔，worker 收数据的循环里不碰它；不传 metrics 就一笔都不记。
+    prometheus() 是 Prometheus 的文本格式；trace() 是 Chrome 的 Trace Event JSON，存下来拖进 chrome://tracing
+    或 ui.perfetto.dev 就是时间线：每个下载一个进程，每条并发的连接一条轨道。
+    事件要接到别处（日志、StatsD……）就传 on_event(name, fields)，或者继承之后改写 event。"""
+    # 名字 -> (类型, 说明)
+    DESCRIPTIONS = {
+        "d2l_downloads_total": ("counter", "结束的下载，result 为 done、changed（远端文件变了）或 bad_url"),
+        "d2l_probe_seconds": ("histogram", "探测花的时间，cached 表示用了探测缓存"),
+        "d2l_startup_seconds": ("histogram", "构造 D2wnloader 加上 start 到第一批 worker 出发花的时间"),
+        "d2l_workers_total": ("counter", "结束的 worker，finish 为 DONE、HELP（分割）、RETIRE、RESTART 或 CANCEL"),
+        "d2l_stalls_total": ("counter", "卡住被重启的连接"),
+        "d2l_received_bytes_total": ("counter", "收到的字节"),
+        "d2l_ttfb_seconds": ("histogram", "发出请求到收到响应头"),
+        "d2l_worker_seconds": ("histogram", "每个 worker 从开始到结束"),
+        "d2l_worker_idle_seconds": ("histogram", "每个 worker 一个字节都没收到的时间"),
+        "d2l_connection_throughput_bytes": ("histogram", "每个 worker 的平均速度，字节/秒"),
+        "d2l_sew_seconds": ("histogram", "组装（预分配模式下是收尾）花的时间"),
+        "d2l_downloaded_bytes": ("gauge", "已下载的字节"),
+        "d2l_workers": ("gauge", "正在跑的 worker"),
+    }
+    SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+    BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(9))  # 1 KB ～ 64 MB
+    MAX_EVENTS = 100000  # 时间线只留最近这么多个事件
+
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self.__values = {}  # (名字, 标签) -> 计数器、仪表的值，或者直方图的 [各桶计数, 总和, 个数]
+        self.__events = collections.deque(maxlen=self.MAX_EVENTS)
+        self.__names = []  # 进程名、轨道名的元数据事件，不随旧事件丢掉
+        self.__pids = {}  # 下载 -> pid
+        self.__tids = {}  # (pid, 轨道) -> tid
+        self.__began = time.time()  # 时间线的零点
+        self.__lock = threading.Lock()
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + n
+
+    def gauge(self, name, value, **labels):
+        with self.__lock:
+            self.__values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        """直方图：以 _bytes 结尾的按字节分桶，其余按秒"""
+        buckets = self.BYTES_BUCKETS if name.endswith("_bytes") else self.SECONDS_BUCKETS
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.__values.get(key)
+            if histogram is None:
+                histogram = self.__values[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def event(self, name, download, track=None, start=None, seconds=None, **fields):
+        """时间线上的一个事件：给了 seconds 是从 start 开始的一段，否则是 start（默认现在）这一刻。
+        track 是轨道，默认是下载本身那一条"""
+        start = time.time() if start is None else start
+        record = {"name": name, "cat": "d2l", "ts": round((start - self.__began) * 1e6), "args": fields}
+        if seconds is not None:
+            record.update(ph="X", dur=round(seconds * 1e6))
+        else:
+            record.update(ph="i", s="t")
+        with self.__lock:
+            record.update(pid=self.__pid(download), tid=self.__tid(download, track))
+            self.__events.append(record)
+        if self.on_event is not None:
+            self.on_event(name, dict(fields, download=download, track=track, start=start, seconds=seconds))
+
+    def sample(self, name, download, **values):
+        """时间线上的曲线（进度、连接数），每个值一条"""
+        record = {"name": name, "cat": "d2l", "ph": "C", "ts": round((time.time() - self.__began) * 1e6),
+                  "args": values}
+        with self.__lock:
+            record.update(pid=self.__pid(download), tid=0)
+            self.__events.append(record)
+
+    def __pid(self, download):
+        if download not in self.__pids:
+            self.__pids[download] = len(self.__pids) + 1
+            self.__names.append({"name": "process_name", "ph": "M", "pid": self.__pids[download],
+                                 "args": {"name": download}})
+        return self.__pids[download]
+
+    def __tid(self, download, track):
+        pid = self.__pids[download]
+        if (pid, track) not in self.__tids:
+            self.__tids[(pid, track)] = len(self.__tids) + 1
+            self.__names.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": self.__tids[(pid, track)],
+                                 "args": {"name": track or download}})
+        return self.__tids[(pid, track)]
+
+    def prometheus(self):
+        """Prometheus 的文本格式"""
+        def labels(pairs, extra=()):
+            pairs = list(pairs) + list(extra)
+            if not pairs:
+                return ""
+            escaped = [(k, str(v).replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")) for k, v in pairs]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        with self.__lock:
+            values = sorted(self.__values.items(), key=lambda item: item[0])
+            values = [(key, [list(v[0]), v[1], v[2]] if isinstance(v, list) else v) for key, v in values]
+        lines = []
+        described = set()
+        for (name, pairs), value in values:
+            kind, description = self.DESCRIPTIONS.get(name, ("histogram" if isinstance(value, list) else "gauge", ""))
+            if name not in described:
+                described.add(name)
+                lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            if not isinstance(value, list):
+                lines.append(f"{name}{labels(pairs)} {value}")
+                continue
+            counts, total, n = value
+            buckets = self.BYTES_BUCKETS if name.endswith("_bytes") else self.SECONDS_BUCKETS
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{labels(pairs, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{labels(pairs, [('le', '+Inf')])} {n}")
+            lines.append(f"{name}_sum{labels(pairs)} {total}")
+            lines.append(f"{name}_count{labels(pairs)} {n}")
+        return "\n".join(lines) + "\n"
+
+    def trace(self):
+        """Chrome 的 Trace Event 格式"""
+        with self.__lock:
+            return {"traceEvents": list(self.__names) + list(self.__events), "displayTimeUnit": "ms"}
+
+    def write_prometheus(self, path):
+        """写成文件（先写临时文件再换名），可以交给 node_exporter 的 textfile collector"""
+        self.__write(path, self.prometheus())
+
+    def write_trace(self, path):
+        self.__write(path, json.dumps(self.trace()))
+
+    @staticmethod
+    def __write(path, text):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
 
 
 class DLWorker:
-    def __init__(self, name: str, url: str, range_start, range_end, cache_dir, finish_callback, user_agent):
+    TIMEOUT = (10, 15)  # 连接超时, 读超时（秒）
+    # 收数据的参数：读进复用的缓冲区，攒够 WRITE_SIZE 才写一次盘
+    WRITE_SIZE = 1024 * 1024
+    MIN_CHUNK = 16 * 1024
+    MAX_CHUNK = 1024 * 1024
+    CHUNK_SECONDS = 0.05  # 自动调节时，让每次读大约花这么久，进度和 help/retire 都不至于迟钝
+
+    def __init__(self, name: str, url: str, range_start, range_end, cache_dir, finish_callback, user_agent, session=None, fd=None, hasher=None,
+                 chunk_size=0, if_range=None, ranged=True, size=None, throttle=None):
         self.name = name
         self.url = url
         self.cache_filename = os.path.join(cache_dir, name + ".d2l")
@@ -23,51 +742,191 @@ class DLWorker:
         self.range_curser = range_start  # curser 所指尚未开始
         self.finish_callback = finish_callback  # 通知调用 DLWorker 的地方
         self.terminate_flag = False  # 该标志用于终结自己
-        self.FINISH_TYPE = ""  # DONE 完成工作, HELP 需要帮忙, RETIRE 不干了
+        self.FINISH_TYPE = ""  # DONE 完成工作, HELP 需要帮忙, RETIRE 不干了, RESTART 换个连接重来, CANCEL 被双胞胎抢先了
         self.user_agent = user_agent
+        self.session = session if session is not None else import_requests()  # 共用 D2wnloader 的连接池
+        self.fd = fd  # 不为 None 时直接按偏移写入预分配好的目标文件，不再写缓存文件
+        self.hasher = hasher  # 不为 None 时写完就喂给 FrontierHasher
+        self.chunk_size = chunk_size  # 每次读多少字节，0 表示按实测速度自动调节
+        self.if_range = if_range  # ETag 或 Last-Modified：远端文件变了的话服务器会回 200 而不是 206
+        self.ranged = ranged  # False 时不带 Range 从头下（服务器不支持 Range）
+        self.size = size  # 整个文件的大小，用来核对 Content-Range / Content-Length
+        self.throttle = throttle  # 不为 None 时每读一块都向令牌桶报账，透支了就睡一会儿
+        self.status = None  # 响应的状态码
+        self.total = None  # Content-Range 里的总大小
+        self.error = None  # 响应没通过核对的原因
+        self.received = 0  # 收到的字节数，只有自己的线程会写，督导随时可以读
+        self.speed = 0.0  # 由督导根据 received 的变化估算
+        self.started_at = time.time()
+        self.first_byte_at = None  # 收到响应头的时间
+        self.idle = 0.0  # 一个字节都没收到的时间，由督导累加
+        self.lane = None  # 开了 metrics 时在时间线上占哪一条轨道
+        self.response = None  # 正在读的响应，interrupt 用
+        self.twin = None  # 收尾阶段下同一段的另一个 worker，谁先下完算谁的
 
-    def __run(self):
-        chunk_size = 1 * 1024  # 1 kb
+    def get_headers(self):
         headers = {
-            'User-Agent': self.user_agent, 
-            'Range': f'Bytes={self.range_curser}-{self.range_end}', 
-            'Accept-Encoding': '*'
+            'User-Agent': self.user_agent,
+            'Accept-Encoding': 'identity'  # 偏移量按原始字节算，不能让服务器压缩
         }
-        req = requests.get(self.url, stream=True, verify=False, headers=headers)
-        ####################################
-        # Informational responses (100–199)
-        # Successful responses (200–299)
-        # Redirection messages (300–399)
-        # Client error responses (400–499)
-        # Server error responses (500–599)
-        ####################################
-        if 200 <= req.status_code <= 299:
-            with open(self.cache_filename, "wb") as cache:
-                for chunk in req.iter_content(chunk_size=chunk_size):
-                    if self.terminate_flag:
-                        break
-                    cache.write(chunk)
-                    self.range_curser += len(chunk)
+        if self.ranged:
+            headers['Range'] = f'Bytes={self.range_curser}-{self.range_end}'
+            if self.if_range:
+                headers['If-Range'] = self.if_range
+        return headers
+
+    def accepts(self, status, headers=None):
+        """带 Range 的请求只认 206：回 200 说明服务器没理会 Range，或者 If-Range 没对上（文件变了）。
+        206 还要核对 Content-Range：起点正是 curser、终点不超出所要的（可以短）、总大小没变，
+        Content-Length 也要和它对得上。对不上的一个字节都不写，原因记在 error 里"""
+        if not (status == 206 if self.ranged else 200 <= status <= 299):
+            return False
+        if headers is None:
+            return True
+        length = headers.get("content-length")  # requests 的 headers 不分大小写，AsyncResponse 的是小写
+        try:
+            if self.ranged:
+                start, end, self.total = parse_content_range(headers.get("content-range"))
+                if start != self.range_curser or end > self.range_end or end < start:
+                    raise ValueError(f"Content-Range {start}-{end}, asked for {self.range_curser}-{self.range_end}")
+                if self.size is not None and self.total is not None and self.total != self.size:
+                    raise ValueError(f"Content-Range size {self.total}, expected {self.size}")
+                expected = end - start + 1
+            else:
+                expected = self.size
+            if length is not None and expected is not None and int(length) != expected:
+                raise ValueError(f"Content-Length {length}, expected {expected}")
+        except ValueError as err:
+            self.error = str(err)
+            return False
+        return True
+
+    def remote_changed(self):
+        """带 Range 的请求收到 200，或者 Content-Range 里的总大小变了：远端文件变了"""
+        return self.ranged and (self.status == 200 or (self.size is not None and self.total not in (None, self.size)))
+
+    def __run(self):
+        import http.client  # urllib3 早就导入了
+        import requests
+        import urllib3
+        chunk_size = self.chunk_size or 64 * 1024
+        headers = self.get_headers()
+        req = None
+        try:
+            # 读超时让卡死的连接最终能退出，没下完的部分由回调交回 AAEK
+            req = self.session.get(self.url, stream=True, verify=False, headers=headers, timeout=self.TIMEOUT)
+            self.first_byte_at = time.time()
+            self.response = req
+            self.status = req.status_code
+            ####################################
+            # Informational responses (100–199)
+            # Successful responses (200–299)
+            # Redirection messages (300–399)
+            # Client error responses (400–499)
+            # Server error responses (500–599)
+            ####################################
+            if self.accepts(req.status_code, req.headers):
+                cache = open(self.cache_filename, "wb") if self.fd is None else None
+                # 直接 readinto 到同一块缓冲区里，满了写一次盘，不再每 1 KB 生成一个 bytes、写一次文件。
+                # urllib3 的 readinto 其实是先 read 出一个 bytes 再拷进来，所以用它底下 http.client 响应的 readinto
+                raw = getattr(req.raw, "_fp", None) or req.raw
+                buffer = memoryview(bytearray(max(self.WRITE_SIZE, self.chunk_size)))
+                filled = 0
+                try:
+                    while not self.terminate_flag:
+                        tick = time.time()
+                        want = min(chunk_size, len(buffer) - filled, self.range_end - self.range_curser + 1 - filled)
+                        if want <= 0:  # 不多读，哪怕服务器给的比要的多
+                            break
+                        if self.throttle is not None:
+                            want = min(want, self.throttle.max_chunk())
+                        n = raw.readinto(buffer[filled:filled + want])
+                        if not n:
+                            break
+                        filled += n
+                        self.received += n
+                        if filled == len(buffer):
+                            self.save(buffer[:filled], cache)
+                            filled = 0
+                        if not self.chunk_size:
+                            # 读满一次花的时间反映这条连接的速度，按 CHUNK_SECONDS 折算下一次读多少
+                            wanted = n / max(time.time() - tick, 1e-3) * self.CHUNK_SECONDS
+                            chunk_size = int(min(max((chunk_size + wanted) / 2, self.MIN_CHUNK), self.MAX_CHUNK))
+                        if self.throttle is not None:
+                            delay = self.throttle.consume(n)
+                            if delay > 0:
+                                time.sleep(delay)
+                finally:
+                    if filled:  # 已经收到的不丢，写完 curser 才前进，回调交回的部分才准确
+                        self.save(buffer[:filled], cache)
+                    if cache is not None:
+                        cache.flush()
+                        os.fsync(cache.fileno())  # 回调里会记进日志，先保证数据落盘
+                        cache.close()
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, http.client.HTTPException, OSError):
+            pass  # 与连接断开一样处理。http.client 的 readinto 没收够 Content-Length 就断开时抛 IncompleteRead
         if not self.terminate_flag:  # 只有正常退出才能标记 DONE，但是三条途径都经过此处
             self.FINISH_TYPE = "DONE"
-        req.close()
+        if req is not None:
+            req.close()
         self.finish_callback(self)  # 执行回调函数，根据 FINISH_TYPE 结局不同
 
+    def save(self, data, cache=None):
+        """把 data 写到 curser 处并前移 curser：预分配模式按偏移写目标文件，否则追加到缓存文件"""
+        if cache is None:
+            pwrite(self.fd, data, self.range_curser)
+        else:
+            cache.write(data)
+            cache.flush()  # 交给操作系统，stream 从另一个句柄也能读到
+        if self.hasher is not None:
+            self.hasher.feed(self.range_curser, data)
+        self.range_curser += len(data)
+
     def start(self):
         threading.Thread(target=self.__run).start()
 
     def help(self):
         self.FINISH_TYPE = "HELP"
         self.terminate_flag = True
+        self.interrupt()
 
     def retire(self):
         self.FINISH_TYPE = "RETIRE"
         self.terminate_flag = True
+        self.interrupt()
+
+    def restart(self):
+        """连接卡住了：交出没干完的部分，换一个新连接接着干"""
+        self.FINISH_TYPE = "RESTART"
+        self.terminate_flag = True
+        self.interrupt()
+
+    def cancel(self):
+        """双胞胎已经下完了同一段，直接收工"""
+        self.FINISH_TYPE = "CANCEL"
+        self.terminate_flag = True
+        self.interrupt()
+
+    def interrupt(self):
+        """卡在 recv 里的线程看不到 terminate_flag，把 socket 关掉让它马上醒过来。
+        curser 只在写完之后才前进，丢掉的只是还没写的那一块。"""
+        try:
+            self.response.raw._connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
 
     def __lt__(self, another):
         """用于排序"""
         return self.range_start < another.range_start
 
+    def get_spans(self):
+        """已经写好的部分 [(start, end, 缓存文件名)]"""
+        return [(self.range_start, self.range_curser - 1, self.cache_filename)]
+
+    def get_unfinished(self):
+        """还没下的部分 [(start, end)]"""
+        return [(self.range_curser, self.range_end)] if self.range_curser <= self.range_end else []
+
     def get_progress(self):
         """获得进度"""
         _progress = {
@@ -78,39 +937,1099 @@ class DLWorker:
         return _progress
 
 
+def parse_content_range(value):
+    """'bytes 0-499/1234' -> (0, 499, 1234)，总大小是 * 时为 None"""
+    m = re.fullmatch(r"\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*", value or "", re.IGNORECASE)
+    if m is None:
+        raise ValueError(f"bad Content-Range: {value!r}")
+    return int(m.group(1)), int(m.group(2)), None if m.group(3) == "*" else int(m.group(3))
+
+
+class BatchDLWorker(DLWorker):
+    """一个请求带上好几段 Range，服务器按 multipart/byteranges 回复，边收边把每一段写到各自的位置。
+    收尾阶段零碎的小洞不必各开一个连接。服务器不支持多段时（回 200，或者只回了一段），
+    能用上的照样写下，multipart 记为 False，D2wnloader 之后改回一段一个请求。
+    每段结束后单独记账（日志、交回），不参与 help 和对冲。"""
+
+    def __init__(self, filename: str, url: str, ranges, cache_dir, finish_callback, user_agent, session=None, fd=None,
+                 hasher=None, chunk_size=0, if_range=None, size=None, throttle=None):
+        super().__init__(f"{filename}.{ranges[0][0]}", url, ranges[0][0], ranges[-1][1], cache_dir, finish_callback,
+                         user_agent, session=session, fd=fd, hasher=hasher, chunk_size=chunk_size, if_range=if_range,
+                         size=size, throttle=throttle)
+        self.ranges = list(ranges)
+        self.cursers = [start for start, _ in self.ranges]
+        self.cache_filenames = [os.path.join(cache_dir, f"{filename}.{start}.d2l") for start, _ in self.ranges]
+        self.range_curser = self.range_end + 1  # 对 help、对冲来说没有可分的
+        self.multipart = None  # 服务器是否按多段回复，收到响应才知道
+        self.replaced = False  # 回 200 时，是不是因为远端文件换了
+
+    def __run(self):
+        import requests
+        import urllib3
+        headers = {
+            'User-Agent': self.user_agent,
+            'Range': 'bytes=' + ','.join([f'{start}-{end}' for start, end in self.ranges]),
+            'Accept-Encoding': 'identity'
+        }
+        if self.if_range:
+            headers['If-Range'] = self.if_range
+        req = None
+        caches = {}
+        try:
+            req = self.session.get(self.url, stream=True, verify=False, headers=headers, timeout=self.TIMEOUT)
+            self.first_byte_at = time.time()
+            self.response = req
+            self.status = req.status_code
+            content_type = req.headers.get("Content-Type", "")
+            if req.status_code == 206 and content_type.lower().startswith("multipart/byteranges"):
+                self.multipart = True
+                boundary = content_type.split("boundary=")[-1].split(";")[0].strip().strip('"')
+                self.__read_parts(io.BufferedReader(req.raw), boundary.encode(), caches)
+            elif req.status_code == 206:  # 只回了一段（有的只给第一段，有的合成一大段）
+                self.multipart = False
+                start, end, total = parse_content_range(req.headers.get("Content-Range"))
+                self.__check(start, end, total, req.headers.get("Content-Length"))
+                self.__route(io.BufferedReader(req.raw), start, end, caches)
+            elif req.status_code == 200:  # 不认多段 Range，或者 If-Range 没对上
+                self.multipart = False
+                self.replaced = self.__is_replaced(req.headers)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError, ValueError):
+            pass  # 与连接断开一样处理，没收完的段由回调交回
+        finally:
+            for cache in caches.values():
+                cache.flush()
+                os.fsync(cache.fileno())
+                cache.close()
+        if not self.terminate_flag:
+            self.FINISH_TYPE = "DONE"
+        if req is not None:
+            req.close()
+        self.finish_callback(self)
+
+    def __is_replaced(self, headers):
+        """有的服务器（比如 S3）对多段 Range 一律回 200 整个文件，这不算变了：
+        响应里的 ETag/Last-Modified 与 If-Range 对不上，或者长度不对，才是远端文件换了"""
+        length = headers.get("Content-Length")
+        if length is not None and self.size is not None and int(length) != self.size:
+            return True
+        return bool(self.if_range) and self.if_range not in (headers.get("ETag"), headers.get("Last-Modified"))
+
+    def remote_changed(self):
+        if self.status == 200:
+            return self.replaced
+        return super().remote_changed()
+
+    def __read_parts(self, stream, boundary, caches):
+        delimiter = b"--" + boundary
+        while not self.terminate_flag:
+            line = stream.readline(1024)
+            if not line:
+                return
+            line = line.strip()
+            if not line:  # 段与段之间的空行
+                continue
+            if line == delimiter + b"--":
+                return
+            if line != delimiter:
+                raise ValueError("bad multipart boundary")
+            content_range = None
+            while True:
+                header = stream.readline(1024).strip()
+                if not header:
+                    break
+                key, _, value = header.decode("latin-1").partition(":")
+                if key.strip().lower() == "content-range":
+                    content_range = value
+            start, end, total = parse_content_range(content_range)
+            self.__check(start, end, total)
+            self.__route(stream, start, end, caches)
+
+    def __check(self, start, end, total, length=None):
+        """与 DLWorker.accepts 一样先核对再写：起点必须正是某一段的 curser，终点不超出所要的（服务器可以把相邻的几段
+        合成一段），总大小没变，Content-Length 对得上。对不上的这段连同后面的都不写，原因记在 error 里"""
+        self.total = total  # 总大小变了的话 remote_changed 会发现
+        if end < start or end > self.range_end or start not in self.cursers:
+            asked = ','.join([f'{curser}-{stop}' for curser, (_, stop) in zip(self.cursers, self.ranges) if curser <= stop])
+            self.error = f"Content-Range {start}-{end}, asked for {asked}"
+        elif self.size is not None and total is not None and total != self.size:
+            self.error = f"Content-Range size {total}, expected {self.size}"
+        elif length is not None and int(length) != end - start + 1:
+            self.error = f"Content-Length {length}, expected {end - start + 1}"
+        if self.error is not None:
+            raise ValueError(self.error)
+
+    def __route(self, stream, start, end, caches):
+        """收下 [start, end]，和哪一段接得上就写到哪一段"""
+        chunk_size = self.chunk_size or 64 * 1024
+        if self.throttle is not None:
+            chunk_size = min(chunk_size, self.throttle.max_chunk())
+        position = start
+        while position <= end and not self.terminate_flag:
+            data = memoryview(stream.read(min(chunk_size, end - position + 1)))
+            if not data:
+                raise ConnectionError("connection closed in part")
+            self.received += len(data)
+            if self.throttle is not None:
+                delay = self.throttle.consume(len(data))
+                if delay > 0:
+                    time.sleep(delay)
+            last = position + len(data) - 1
+            for i, (_, range_end) in enumerate(self.ranges):
+                lo, hi = max(position, self.cursers[i]), min(last, range_end)
+                if lo == self.cursers[i] and lo <= hi:
+                    self.__write(i, data[lo - position:hi - position + 1], caches)
+            position = last + 1
+
+    def __write(self, i, data, caches):
+        if self.fd is not None:
+            pwrite(self.fd, data, self.cursers[i])
+        else:
+            if i not in caches:
+                caches[i] = open(self.cache_filenames[i], "wb")
+            caches[i].write(data)
+            caches[i].flush()
+        if self.hasher is not None:
+            self.hasher.feed(self.cursers[i], data)
+        self.cursers[i] += len(data)
+
+    def start(self):
+        threading.Thread(target=self.__run).start()
+
+    def get_spans(self):
+        return [(start, curser - 1, cache_filename) for (start, _), curser, cache_filename in
+                zip(self.ranges, list(self.cursers), self.cache_filenames) if curser > start]
+
+    def get_unfinished(self):
+        return [(curser, end) for (_, end), curser in zip(self.ranges, list(self.cursers)) if curser <= end]
+
+
+class RangeLease(DLWorker):
+    """分布式模式下协调者这边的“虚拟 worker”：一段区间租给远程 worker 去下，数据经 HTTP 一段段送回来，
+    由它接着 curser 写进缓存文件（或预分配的目标文件）。对 D2wnloader 来说和本地 worker 一样，
+    help、retire、restart、cancel 照常，远程 worker 下次送数据时收到 410 才知道租约收回了。
+    过了 expires 还没有消息就当远程 worker 死了，督导会 restart 它，没下完的部分交回 AAEK。"""
+    SECONDS = 15  # 多久没消息算过期，每次送数据都会续上
+
+    def __init__(self, lease_id, name: str, url: str, range_start, range_end, cache_dir, finish_callback, user_agent,
+                 fd=None, hasher=None, if_range=None):
+        super().__init__(name=name, url=url, range_start=range_start, range_end=range_end, cache_dir=cache_dir,
+                         finish_callback=finish_callback, user_agent=user_agent, fd=fd, hasher=hasher,
+                         if_range=if_range)
+        self.lease_id = lease_id
+        self.expires = time.time() + self.SECONDS
+        self.__cache = None
+        self.__closed = False
+        self.__lock = threading.Lock()  # 送数据的请求和收回租约可能同时发生
+
+    def start(self):
+        if self.fd is None:
+            self.__cache = open(self.cache_filename, "wb")
+        self.expires = time.time() + self.SECONDS
+
+    def write(self, offset, data):
+        """远程 worker 送来 offset 开始的 data，只接着 curser 写（重发的部分跳过）。返回 False 表示租约已经收回"""
+        with self.__lock:
+            if self.__closed or offset > self.range_curser:
+                return False
+            now = time.time()
+            self.expires = now + self.SECONDS
+            if self.first_byte_at is None:  # 远程 worker 第一次送数据来
+                self.first_byte_at = now
+            data = data[self.range_curser - offset:self.range_end - offset + 1]
+            if data:
+                self.save(data, self.__cache)
+                self.received += len(data)
+            done = self.range_curser > self.range_end
+        if done:
+            self.finish()
+        return True
+
+    def finish(self, status=None):
+        """远程 worker 说这段结束了（下完，或者源站出错），或者租约被收回"""
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            if status is not None:
+                self.status = status
+            if self.__cache is not None:
+                self.__cache.flush()
+                os.fsync(self.__cache.fileno())  # 回调里会记进日志，先保证数据落盘
+                self.__cache.close()
+        if not self.terminate_flag:
+            self.FINISH_TYPE = "DONE"
+        self.finish_callback(self)
+
+    def interrupt(self):
+        # 和本地 worker 一样，回调来自另一个线程：调用 help/cancel 的地方可能正拿着锁遍历 workers
+        threading.Thread(target=self.finish).start()
+
+
+def make_coordinator_server(downloader, address):
+    """协调者的 HTTP 接口，给 RemoteWorker 用：
+    POST /lease 租一段；PUT /data/<租约>?offset=<偏移> 送回数据；POST /release/<租约> 结束租约。
+    光导入 http.server 就要二十几毫秒，只有开了协调者才用得着，所以到这里才导入、才建这两个类"""
+    import http.server
+
+    class CoordinatorHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def log_message(self, format, *args):
+            pass
+
+        def __reply(self, status, body=None):
+            data = json.dumps(body or {}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def __body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_POST(self):
+            body = self.__body()
+            if self.path == "/lease":
+                self.__reply(200, downloader.grant_lease())
+            elif self.path.startswith("/release/"):
+                try:
+                    status = json.loads(body or b"{}").get("status")
+                except ValueError:
+                    status = None
+                downloader.release_lease(self.path[len("/release/"):], status)
+                self.__reply(200)
+            else:
+                self.__reply(404)
+
+        def do_PUT(self):
+            body = self.__body()
+            m = re.fullmatch(r"/data/(\w+)\?offset=(\d+)", self.path)
+            if m is None:
+                self.__reply(404)
+                return
+            ok = downloader.feed_lease(m.group(1), int(m.group(2)), body)
+            self.__reply(200 if ok else 410)
+
+    class CoordinatorServer(http.server.ThreadingHTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            pass  # 远程 worker 断开是常事，租约到期自会收回
+
+    return CoordinatorServer(address, CoordinatorHandler)
+
+
+class RemoteWorker:
+    """分布式模式里跑在别的机器（或别的进程）上的 worker：向协调者租一段，自己去源站下，
+    边下边把数据 PUT 回协调者。租约被收回（help、retire、对冲输了）时协调者回 410，放下这段再租下一段。
+    同时开 threads 个租约；协调者说全部下完（或者一直连不上）时 run 返回。"""
+    PIECE = 256 * 1024  # 每次送回多少字节，也是续租的间隔：源站再慢也得在 RangeLease.SECONDS 内读满一块
+    MAX_FAILURES = 5  # 连续这么多次连不上协调者就退出
+
+    def __init__(self, coordinator: str, threads: int = 4):
+        self.coordinator = coordinator.rstrip("/")
+        self.threads = threads
+        self.user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:97.0) Gecko/20100101 Firefox/97.0'
+        requests = import_requests()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=2 * threads, pool_block=False)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.received = 0  # 各线程累加，只作统计
+
+    def run(self):
+        threads = [threading.Thread(target=self.__loop) for _ in range(self.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return self.received
+
+    def __loop(self):
+        import requests
+        failures = 0
+        while failures < self.MAX_FAILURES:
+            try:
+                job = self.session.post(f"{self.coordinator}/lease", timeout=DLWorker.TIMEOUT).json()
+            except (requests.exceptions.RequestException, ValueError):
+                failures += 1
+                time.sleep(1)
+                continue
+            failures = 0
+            if job.get("done"):
+                return
+            if "wait" in job:
+                time.sleep(job["wait"])
+                continue
+            self.__fetch(job)
+
+    def __fetch(self, job):
+        import requests
+        import urllib3
+        headers = {'User-Agent': self.user_agent, 'Accept-Encoding': 'identity',
+                   'Range': f'Bytes={job["start"]}-{job["end"]}'}
+        if job.get("if_range"):
+            headers['If-Range'] = job["if_range"]
+        lease_url = f"{self.coordinator}/data/{job['lease']}"
+        status, req = None, None
+        try:
+            req = self.session.get(job["url"], stream=True, verify=False, headers=headers, timeout=DLWorker.TIMEOUT)
+            status = req.status_code
+            offset = job["start"]
+            if status == 206 and parse_content_range(req.headers.get("Content-Range"))[0] != offset:
+                status = None  # 给的不是要的那一段，一个字节都不送回去
+            while status == 206 and offset <= job["end"]:
+                data = req.raw.read(min(self.PIECE, job["end"] - offset + 1))
+                if not data:
+                    break
+                r = self.session.put(lease_url, params={"offset": offset}, data=data, timeout=DLWorker.TIMEOUT)
+                if r.status_code != 200:  # 410：租约收回了
+                    break
+                offset += len(data)
+                self.received += len(data)
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError, ValueError):
+            pass  # 没送回的部分，协调者在租约结束（或到期）后交回 AAEK
+        finally:
+            if req is not None:
+                req.close()
+        try:
+            self.session.post(f"{self.coordinator}/release/{job['lease']}", json={"status": status},
+                              timeout=DLWorker.TIMEOUT)
+        except requests.exceptions.RequestException:
+            pass
+
+
+class TokenBucket:
+    """令牌桶（字节/秒），最多攒 burst 字节。可以透支：consume 直接扣，返回还清透支要等多久，
+    由调用方自己去睡，锁里只做几次加减。rate 随时可以改（BandwidthLimiter 按优先级调整）"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate * 0.1, 64 * 1024)
+        self.__tokens = self.burst
+        self.__stamp = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def consume(self, n):
+        with self.__lock:
+            now = time.monotonic()
+            rate = self.rate
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__stamp) * rate)
+            self.__stamp = now
+            self.__tokens -= n
+            return -self.__tokens / rate if self.__tokens < 0 and rate > 0 else 0.0
+
+
+class BandwidthLimiter:
+    """几个下载共用的限速器：总速率 rate（0 不限），另可按主机限速 per_host={主机: 字节/秒}。
+    优先级 URGENT、NORMAL、BACKGROUND：每一级能用的是总速率减去比它急的那几级最近实际用掉的（多留一点余量），
+    急的下载一跑起来，带宽在几个调整周期内就归它，不急的自动让出来；急的没在用时不急的可以用满。"""
+    URGENT, NORMAL, BACKGROUND = 0, 1, 2
+    REBALANCE_SECONDS = 0.2  # 多久按各级的实际用量重新分一次
+    SMOOTHING = 0.5
+    HEADROOM = 1.2  # 给急的留出比实际用量多这么多，它才涨得上去
+    MIN_SHARE = 0.05  # 再不急也留这么多，免得连接饿到超时
+
+    def __init__(self, rate=0, per_host=None):
+        self.rate = rate
+        self.bucket = TokenBucket(rate)
+        self.hosts = {host: TokenBucket(r) for host, r in (per_host or {}).items()}
+        self.classes = {}  # 优先级 -> TokenBucket
+        self.__used = {}  # 优先级 -> 这个周期收到的字节
+        self.__speed = {}  # 优先级 -> 平滑后的速率
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """随时改总速率"""
+        with self.__lock:
+            self.rate = rate
+            self.bucket.rate = rate
+            for bucket in self.classes.values():
+                bucket.rate = min(bucket.rate, rate)
+
+    def throttle(self, host, bucket=None, priority=NORMAL):
+        """给一个下载连向 host 的 worker 用的 Throttle，bucket 是这个下载自己的限速。什么都不限时返回 None"""
+        buckets = [bucket] if bucket is not None else []
+        if host in self.hosts:
+            buckets.append(self.hosts[host])
+        if self.rate:
+            with self.__lock:
+                if priority not in self.classes:
+                    self.classes[priority] = TokenBucket(self.rate)
+                buckets += [self.classes[priority], self.bucket]
+        return Throttle(buckets, self if self.rate else None, priority) if buckets else None
+
+    def account(self, priority, n):
+        """记下 priority 这一级收到了 n 字节，到时间了就重新分配各级的速率"""
+        with self.__lock:
+            self.__used[priority] = self.__used.get(priority, 0) + n
+            now = time.monotonic()
+            dt = now - self.__last
+            if dt < self.REBALANCE_SECONDS:
+                return
+            self.__last = now
+            remaining = self.rate
+            for p in sorted(self.classes):
+                self.__speed[p] = self.SMOOTHING * self.__speed.get(p, 0.0) + \
+                    (1 - self.SMOOTHING) * self.__used.get(p, 0) / dt
+                self.classes[p].rate = max(remaining, self.rate * self.MIN_SHARE)
+                remaining -= self.__speed[p] * self.HEADROOM
+            self.__used = {}
+
+    def get_stats(self):
+        """各优先级最近的速率和当前分到的速率，字节/秒"""
+        with self.__lock:
+            return {p: {"speed": self.__speed.get(p, 0.0), "rate": b.rate} for p, b in self.classes.items()}
+
+
+class Throttle:
+    """一个下载（连向某个主机的 worker）用的限速：收到的字节依次向几个令牌桶报账，等透支最多的那个还清"""
+
+    def __init__(self, buckets, limiter=None, priority=BandwidthLimiter.NORMAL):
+        self.buckets = buckets
+        self.limiter = limiter
+        self.priority = priority
+
+    def consume(self, n):
+        delay = 0.0
+        for bucket in self.buckets:
+            delay = max(delay, bucket.consume(n))
+        if self.limiter is not None:
+            self.limiter.account(self.priority, n)
+        return delay
+
+    def max_chunk(self, minimum=16 * 1024):
+        """一次最多读多少：最紧的那个桶大约 50 ms 的量，免得一次读太多、接着一睡好几秒（会被当成卡住）"""
+        return max(int(min(b.rate for b in self.buckets) * 0.05), minimum)
+
+
+class ConcurrencyController:
+    """自适应并发数：每隔 EVAL_TICKS 个督导周期比较一次吞吐量。
+    试探着加（或减）一个 worker，吞吐量明显上升就沿这个方向继续，否则退回上一个值并稳定一阵，
+    下一次换个方向试探。稳定下来的值按主机记住，同一主机的下一个下载直接从这里开始。"""
+    EVAL_TICKS = 8  # 评估周期，乘以督导的 REFRESH_INTERVAL 就是秒数
+    GAIN_THRESHOLD = 0.05  # 吞吐量至少提高这么多才算有用
+    HOLD_EVALS = 5  # 退回之后稳定几个评估周期再试探
+    MAXIMUM = 32  # 与 blocks_num 的上限一致
+    best_by_host = {}
+
+    def __init__(self, host, initial, minimum=1, maximum=MAXIMUM):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = max(minimum, min(maximum, self.best_by_host.get(host, initial or minimum)))
+        self.__samples = []
+        self.__last = None  # 上一次评估时的 (target, 吞吐量)
+        self.__direction = 1
+        self.__hold = 0
+
+    def __clamp(self, n):
+        return max(self.minimum, min(self.maximum, n))
+
+    def update(self, speed):
+        """每个督导周期喂一次当前总速度，返回目标并发数"""
+        self.__samples.append(speed)
+        if len(self.__samples) < self.EVAL_TICKS:
+            return self.target
+        # 前一半是刚调整完的爬坡期，不算
+        recent = self.__samples[self.EVAL_TICKS // 2:]
+        throughput = sum(recent) / len(recent)
+        self.__samples = []
+        if self.__hold > 0:
+            self.__hold -= 1
+            return self.target
+        if self.__last is None:  # 开始一次试探
+            self.__last = (self.target, throughput)
+            self.target = self.__clamp(self.target + self.__direction)
+            if self.target == self.__last[0]:  # 到边界了，换方向
+                self.__direction = -self.__direction
+                self.__last = None
+            return self.target
+        last_target, last_throughput = self.__last
+        if throughput > last_throughput * (1 + self.GAIN_THRESHOLD):  # 有用，继续
+            self.__last = (self.target, throughput)
+            self.target = self.__clamp(self.target + self.__direction)
+            if self.target == self.__last[0]:
+                self.__settle(self.target)
+        else:  # 没用，退回去
+            self.__settle(last_target)
+            self.__direction = -self.__direction
+        return self.target
+
+    def __settle(self, target):
+        self.target = target
+        self.best_by_host[self.host] = target
+        self.__last = None
+        self.__hold = self.HOLD_EVALS
+
+
+class MirrorPool:
+    """同一个文件的几个镜像。每个镜像按单连接的实测吞吐量打分（指数平滑），
+    新 worker 去 (正在用的连接数 + 1) / 分数 最小的镜像，连接数因此与吞吐量成正比。
+    连续失败（5xx、一个字节没拿到就断开、卡住被重启）的镜像暂时降级，冷却时间逐次加倍。"""
+    SMOOTHING = 0.3  # 新测量值的权重
+    DEMOTE_AFTER = 2  # 连续失败几次降级
+    DEMOTE_SECONDS = 5  # 第一次降级多久，之后每次加倍
+    DEMOTE_MAX_SECONDS = 60
+
+    def __init__(self, urls):
+        self.urls = list(urls)
+        self.speed = {url: None for url in self.urls}  # 字节/秒，None 表示还没测过
+        self.failures = {url: 0 for url in self.urls}
+        self.demoted_until = {url: 0.0 for url in self.urls}
+        self.__lock = threading.Lock()
+
+    def __score(self, url):
+        measured = [v for v in self.speed.values() if v]
+        if not self.speed[url]:
+            return max(measured) if measured else 1.0  # 没测过的先乐观地试试
+        return self.speed[url]
+
+    def pick(self, active, exclude=None):
+        """active: {url: 正在用的连接数}。exclude 尽量不选（比如给对冲的 worker 换个镜像）"""
+        with self.__lock:
+            now = time.time()
+            candidates = [u for u in self.urls if self.demoted_until[u] <= now and u != exclude]
+            if not candidates:
+                candidates = [u for u in self.urls if u != exclude] or self.urls
+                candidates = [min(candidates, key=lambda u: self.demoted_until[u])]  # 都降级了就用最先恢复的
+            return min(candidates, key=lambda u: (active.get(u, 0) + 1) / self.__score(u))
+
+    def report(self, url, received, seconds, ok):
+        """一个 worker 结束时汇报：收到多少字节、用了多久、这条连接是否正常"""
+        with self.__lock:
+            if url not in self.speed:
+                return
+            if received > 0 and seconds > 0:
+                speed = received / seconds
+                last = self.speed[url]
+                self.speed[url] = speed if last is None else last + self.SMOOTHING * (speed - last)
+            if ok:
+                self.failures[url] = 0
+                return
+            self.failures[url] += 1
+            if self.failures[url] >= self.DEMOTE_AFTER:
+                cooldown = self.DEMOTE_SECONDS * 2 ** (self.failures[url] - self.DEMOTE_AFTER)
+                self.demoted_until[url] = time.time() + min(cooldown, self.DEMOTE_MAX_SECONDS)
+
+    def get_stats(self):
+        now = time.time()
+        with self.__lock:
+            return {url: {"speed": self.speed[url] or 0.0, "failures": self.failures[url],
+                          "demoted": self.demoted_until[url] > now} for url in self.urls}
+
+
+_event_loop = None
+_running_tasks = set()
+_event_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """async 引擎共用的事件循环，第一次用到时才在一个后台线程里跑起来"""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            import asyncio
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            _event_loop = loop
+        return _event_loop
+
+
+class AsyncResponse:
+    """极简的 HTTP/1.1 响应：支持 Content-Length、chunked 以及读到连接关闭为止三种 body"""
+
+    def __init__(self, reader, writer, status, headers):
+        self.reader = reader
+        self.writer = writer
+        self.status = status
+        self.headers = headers  # 小写的 key
+        self.__chunked = headers.get("transfer-encoding", "").lower() == "chunked"
+        self.__remain = int(headers["content-length"]) if "content-length" in headers and not self.__chunked else None
+        self.__chunk_remain = 0
+        self.__eof = self.__remain == 0
+        self.reusable = headers.get("connection", "").lower() != "close" and (self.__chunked or self.__remain is not None)
+
+    async def read(self, n):
+        """最多读 n 个字节，读完返回 b\"\" """
+        if self.__eof:
+            return b""
+        if self.__chunked:
+            if self.__chunk_remain == 0:
+                line = await self.reader.readuntil(b"\r\n")
+                self.__chunk_remain = int(line.split(b";")[0].strip(), 16)
+                if self.__chunk_remain == 0:
+                    while (await self.reader.readuntil(b"\r\n")) != b"\r\n":  # trailer
+                        pass
+                    self.__eof = True
+                    return b""
+            data = await self.reader.read(min(n, self.__chunk_remain))
+            if not data:
+                raise ConnectionError("connection closed in chunk")
+            self.__chunk_remain -= len(data)
+            if self.__chunk_remain == 0:
+                await self.reader.readexactly(2)
+            return data
+        if self.__remain is not None:
+            data = await self.reader.read(min(n, self.__remain))
+            if not data:
+                raise ConnectionError("connection closed before Content-Length")
+            self.__remain -= len(data)
+            self.__eof = self.__remain == 0
+            return data
+        data = await self.reader.read(n)
+        self.__eof = not data
+        return data
+
+    def done(self):
+        return self.__eof
+
+
+class AsyncConnectionPool:
+    """asyncio 版的 keep-alive 连接池，按 (scheme, host, port) 分组，用法和统计与 requests 的连接池对应"""
+
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.__idle = {}
+
+    async def __connect(self, key, fresh=False):
+        import asyncio
+        idle = self.__idle.setdefault(key, [])
+        while idle and not fresh:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                self.hits += 1
+                return reader, writer, True
+            writer.close()
+        import ssl
+        self.misses += 1
+        scheme, host, port = key
+        ssl_context = None
+        if scheme == "https":  # 与 DLWorker 的 verify=False 保持一致
+            ssl_context = ssl.create_default_context()
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+        return reader, writer, False
+
+    async def get(self, url, headers, max_redirects=5):
+        """发送 GET，跟随重定向，返回 (AsyncResponse, 最终的 url)"""
+        import asyncio
+        for _ in range(max_redirects + 1):
+            parts = parse.urlsplit(url)
+            port = parts.port or (443 if parts.scheme == "https" else 80)
+            key = (parts.scheme, parts.hostname, port)
+            host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+            path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+            lines = [f"GET {path} HTTP/1.1", f"Host: {host}", "Connection: keep-alive"]
+            lines += [f"{k}: {v}" for k, v in headers.items()]
+            request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+            fresh = False
+            while True:
+                reader, writer, reused = await self.__connect(key, fresh)
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    head = await reader.readuntil(b"\r\n\r\n")
+                    break
+                except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    writer.close()
+                    if not reused:
+                        raise
+                    fresh = True  # 复用的连接已被服务器关掉，换新连接再试一次
+            status_line, *header_lines = head.decode("latin-1").split("\r\n")
+            status = int(status_line.split(" ")[1])
+            response_headers = {}
+            for line in header_lines:
+                if ":" in line:
+                    k, v = line.split(":", 1)
+                    response_headers[k.strip().lower()] = v.strip()
+            response = AsyncResponse(reader, writer, status, response_headers)
+            response.key = key
+            if 300 <= status <= 399 and "location" in response_headers:
+                self.release(response, reusable=False)
+                url = parse.urljoin(url, response_headers["location"])
+                continue
+            return response, url
+        raise ConnectionError("too many redirects")
+
+    def release(self, response, reusable=True):
+        idle = self.__idle.setdefault(response.key, [])
+        if reusable and response.reusable and response.done() and len(idle) < self.maxsize:
+            idle.append((response.reader, response.writer))
+        else:
+            response.writer.close()
+
+
+class AsyncDLWorker(DLWorker):
+    """与 DLWorker 接口一致（help、retire、get_progress、回调），但跑在共用的事件循环上，不占线程"""
+
+    def __init__(self, name: str, url: str, range_start, range_end, cache_dir, finish_callback, user_agent, pool, fd=None,
+                 hasher=None, chunk_size=0, if_range=None, ranged=True, size=None, throttle=None):
+        super().__init__(name, url, range_start, range_end, cache_dir, finish_callback, user_agent, fd=fd, hasher=hasher,
+                         chunk_size=chunk_size, if_range=if_range, ranged=ranged, size=size, throttle=throttle)
+        self.pool = pool
+
+    async def __arun(self):
+        """事件循环上只收数据；打开、写入（连同喂给摘要）、fsync 这些磁盘操作都交给线程池，一个 worker 的慢盘不拖累别的连接"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        chunk_size = self.chunk_size or 64 * 1024  # StreamReader 有多少给多少，不会为了读满而等待，不需要自动调节
+        headers = self.get_headers()
+        response = None
+        try:
+            response, _ = await asyncio.wait_for(self.pool.get(self.url, headers), self.TIMEOUT[0])
+            self.first_byte_at = time.time()
+            self.response = response
+            self.status = response.status
+            if self.accepts(response.status, response.headers):
+                cache = await loop.run_in_executor(None, open, self.cache_filename, "wb") if self.fd is None else None
+                pending = bytearray()  # 攒够 WRITE_SIZE 再写盘
+                try:
+                    while not self.terminate_flag:
+                        want = min(chunk_size, self.range_end - self.range_curser + 1 - len(pending))
+                        if want <= 0:
+                            break
+                        if self.throttle is not None:
+                            want = min(want, self.throttle.max_chunk())
+                        chunk = await asyncio.wait_for(response.read(want), self.TIMEOUT[1])
+                        if not chunk:
+                            break
+                        pending += chunk
+                        self.received += len(chunk)
+                        if self.throttle is not None:
+                            delay = self.throttle.consume(len(chunk))
+                            if delay > 0:
+                                await asyncio.sleep(delay)
+                        if len(pending) >= self.WRITE_SIZE:
+                            await loop.run_in_executor(None, self.save, pending, cache)
+                            pending.clear()
+                finally:
+                    if pending:
+                        await loop.run_in_executor(None, self.save, pending, cache)
+                    if cache is not None:
+                        await loop.run_in_executor(None, self.__close, cache)
+        except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass  # 与连接断开一样处理：没下完的部分由回调交回 AAEK
+        except Exception as err:  # 比如 chunk 长度那一行超过 64 KB 时 readuntil 抛的 LimitOverrunError
+            self.error = f"{type(err).__name__}: {err}"
+        finally:
+            # 不管怎么结束都要回调，否则 worker 永远留在 workers 里，下载和 stop 都等不到头
+            if response is not None:
+                self.pool.release(response, reusable=not self.terminate_flag)
+            if not self.terminate_flag:
+                self.FINISH_TYPE = "DONE"
+            # 回调里可能要 fsync、组装文件，放到线程池里做，不卡事件循环
+            loop.run_in_executor(None, self.finish_callback, self)
+
+    @staticmethod
+    def __close(cache):
+        cache.flush()
+        os.fsync(cache.fileno())  # 回调里会记进日志，先保证数据落盘
+        cache.close()
+
+    def start(self):
+        get_event_loop().call_soon_threadsafe(self.__spawn)
+
+    def interrupt(self):
+        response = self.response
+        if response is not None:
+            get_event_loop().call_soon_threadsafe(response.writer.transport.abort)
+
+    def __spawn(self):
+        # 事件循环对 Task 只持弱引用，自己拿着，免得半路被回收
+        import asyncio
+        task = asyncio.get_running_loop().create_task(self.__arun())
+        _running_tasks.add(task)
+        task.add_done_callback(_running_tasks.discard)
+
+
+class DLManager:
+    """多文件下载：排队的 URL 共用一个总连接数上限，同一主机另有上限。
+    每个 D2wnloader 申请 worker 前先来这里拿名额；worker 结束后名额交回，
+    由 dispatch 分给同一主机还有余量、且离完成最远的那个下载。"""
+
+    def __init__(self, urls=(), download_dir: str = f".{os.sep}d2l{os.sep}", max_connections: int = 32,
+                 per_host: int = 8, max_active: int = 0, **kwargs):
+        self.download_dir = download_dir
+        self.max_connections = max_connections
+        self.per_host = per_host
+        self.max_active = max_active or max_connections  # 同时进行的下载数
+        self.kwargs = kwargs  # 传给每个 D2wnloader 的其余参数
+        self.queue = []
+        self.active = []
+        self.results = {}  # url -> "done" / "failed"
+        self.__names = {}  # url -> 保存的文件名
+        self.__used = 0
+        self.__used_by_host = {}
+        self.__lock = threading.RLock()
+        self.__idle = threading.Event()
+        for url in urls:
+            self.add(url)
+
+    def add(self, url: str):
+        """排进队列，已经在排队或者正在下的不重复下"""
+        with self.__lock:
+            if url in self.queue or any(d.url == url for d in self.active):
+                return
+            if url not in self.__names:
+                self.__names[url] = self.__unique_name(url)
+            self.queue.append(url)
+            self.__idle.clear()
+
+    def __unique_name(self, url):
+        """目标文件、缓存、日志都按文件名存，不同 URL 的文件名撞了（不同目录下的同名文件）就改成 name (1).ext，
+        按排队的顺序编号，同样的 URL 列表下次续传时还是同样的名字"""
+        name = parse.unquote(url.split("/")[-1])
+        taken = set(self.__names.values())
+        stem, ext = os.path.splitext(name)
+        n = 0
+        while name in taken:
+            n += 1
+            name = f"{stem} ({n}){ext}"
+        return name
+
+    def acquire(self, downloader, n):
+        """申请 n 个连接名额，返回实际拿到的数量"""
+        with self.__lock:
+            host_used = self.__used_by_host.get(downloader.host, 0)
+            granted = max(0, min(n, self.max_connections - self.__used, self.per_host - host_used))
+            self.__used += granted
+            self.__used_by_host[downloader.host] = host_used + granted
+            return granted
+
+    def release(self, downloader, n):
+        if n <= 0:
+            return
+        with self.__lock:
+            self.__used -= n
+            self.__used_by_host[downloader.host] -= n
+
+    def get_usage(self):
+        with self.__lock:
+            return {"total": self.__used, "hosts": dict(self.__used_by_host)}
+
+    def dispatch(self):
+        """把空闲名额分给离完成最远的下载，每个下载每轮最多加一个 worker。
+        都没有未开垦的部分时，只让最需要的那个请人帮忙（一分为二），免得 help 一窝蜂。"""
+        with self.__lock:
+            candidates = sorted([d for d in self.active if not d.is_done()], key=lambda d: d.get_progress())
+        helped = False
+        for d in candidates:
+            with self.__lock:
+                if self.__used >= self.max_connections:
+                    return
+                if self.__used_by_host.get(d.host, 0) >= self.per_host:
+                    continue
+            if len(d.AAEK) > 0:
+                d.workaholic(1)
+            elif not helped:
+                helped = True
+                d.workaholic(1)
+
+    def __run_one(self, url):
+        d = D2wnloader(url, download_dir=self.download_dir, manager=self, filename=self.__names[url], **self.kwargs)
+        with self.__lock:
+            self.__starting -= 1
+            if d.is_bad_url():
+                self.results[url] = "failed"
+            else:
+                self.active.append(d)
+        if d.is_bad_url():
+            self.__next()
+            return
+        d.start()
+        with self.__lock:
+            self.active.remove(d)
+            self.results[url] = "done" if d.is_done() else "failed"
+        self.__next()
+        self.dispatch()
+
+    def __next(self):
+        """队列里还有就开新的下载，没有了且都结束了就放行 run"""
+        with self.__lock:
+            while self.queue and len(self.active) + self.__starting < self.max_active:
+                url = self.queue.pop(0)
+                self.__starting += 1
+                threading.Thread(target=self.__start_one, args=(url,)).start()
+            if not self.queue and not self.active and self.__starting == 0:
+                self.__idle.set()
+
+    def __start_one(self, url):
+        try:
+            self.__run_one(url)
+        except Exception as err:
+            with self.__lock:
+                if url not in self.results and all(d.url != url for d in self.active):
+                    self.__starting -= 1  # 没来得及登记就出错了
+                self.results[url] = "failed"
+            sys.stdout.write(f"\r[Error] {url} {err}\n")
+            self.__next()
+
+    def run(self):
+        """下载队列里的全部 URL，全部结束后返回 results"""
+        self.__starting = 0
+        self.__idle.clear()
+        self.__next()
+        self.__idle.wait()
+        return self.results
+
+
 class D2wnloader:
-    def __init__(self, url: str, download_dir: str = f".{os.sep}d2l{os.sep}", blocks_num: int = 8):
+    def __init__(self, url: str, download_dir: str = f".{os.sep}d2l{os.sep}", blocks_num: int = 8,
+                 preallocate: bool = False, engine: str = "thread", manager=None, hashes=(), chunk_size: int = 0,
+                 mirrors=(), probe_ttl: int = ProbeCache.TTL, manifest=None, seeds=(), coordinator=None,
+                 limiter=None, rate_limit: int = 0, priority: int = BandwidthLimiter.NORMAL, metrics=None,
+                 filename: str = None):
+        self.__options = {k: v for k, v in locals().items() if k != "self"}  # 缓存的探测结果过期时照原样重建
+        created = time.time()
         assert 0 <= blocks_num <= 32
+        assert engine in ("thread", "async")
         self.url = url
         self.user_agent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:97.0) Gecko/20100101 Firefox/97.0'
-        filename = self.url.split("/")[-1]
-        filename = parse.unquote(filename)
+        if filename is None:  # 默认取 URL 的最后一段
+            filename = self.url.split("/")[-1]
+            filename = parse.unquote(filename)
         self.filename = filename
         self.download_dir = download_dir
         self.blocks_num = blocks_num
+        self.preallocate = preallocate  # 预分配目标文件，worker 按偏移直接写入，省掉 __sew 的整文件拷贝
+        self.engine = engine  # thread：每个分块一个线程；async：所有下载的所有分块共用一个事件循环
+        self.manager = manager  # 由 DLManager 统一分配连接数时不为 None
+        self.hashes = tuple(hashes)  # 边下边算的摘要，比如 ("md5", "sha256")
+        self.hasher = None
+        self.chunk_size = chunk_size  # worker 每次读多少字节，0 表示按每条连接的速度自动调节
+        # 限速：limiter 是几个下载共用的（总速率、按主机、优先级），rate_limit 是这个下载自己的上限（字节/秒）
+        self.limiter = limiter if limiter is not None or not rate_limit else BandwidthLimiter()
+        self.rate_bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.priority = priority
+        self.metrics = metrics  # Metrics：计数器、直方图和时间线，几个下载可以共用。None 时什么都不记
+        self.__started_at = None  # start 的时间
+        self.__throttles = {}  # 主机 -> Throttle，镜像在别的主机上时按各自的主机限速
+        self.host = parse.urlsplit(url).hostname
+        self.session = self.__get_session()  # 所有 worker 共用，restart 之后也继续复用
+        self.cache_dir = f".{os.sep}d2l{os.sep}.cache{os.sep}"
+        self.probe_cache = ProbeCache(os.path.join(self.cache_dir, "probe.json"), ttl=probe_ttl)
+        self.chunk_index = ChunkIndex(os.path.join(self.cache_dir, "chunks.json"))
+        self.manifest = None  # 块清单：有的话开始前先从本地拷贝内容没变的块
         self.__bad_url_flag = False
+        self.__changed = False  # 下载途中发现远端文件变了
+        self.__probe_cached = False  # 大小、ETag 是从探测缓存里拿的，不是刚探测的
+        self.final_url = url  # 跳转之后的地址，worker 直接请求它
+        self.etag = ""
+        self.last_modified = ""
+        self.accept_ranges = True
         self.file_size = self.__get_size()
+        # 续传时带上 If-Range，文件变了服务器会回整个文件而不是 206。弱 ETag 不能用于 If-Range
+        self.if_range = (self.etag if self.etag and not self.etag.startswith("W/") else self.last_modified) or None
+        # 镜像：大小（以及双方都有的 ETag）与主地址一致才会混用
+        self.mirror_pool = MirrorPool([self.final_url] + self.__check_mirrors(mirrors)) if mirrors else None
         if not self.__bad_url_flag:
             # 建立下载目录
             if not os.path.exists(self.download_dir):
                 os.makedirs(self.download_dir)
             # 建立缓存目录
-            self.cache_dir = f".{os.sep}d2l{os.sep}.cache{os.sep}"
             if not os.path.exists(self.cache_dir):
                 os.makedirs(self.cache_dir)
+            # 日志 flush 时 __sync_target 要看有哪些 worker 在跑，导入旧缓存、从本地拷块时就会 flush，所以先建好
+            self.workers = []  # 装载 DLWorker
+            self.__lock = threading.RLock()  # worker 的回调来自各自的线程，改动共享状态时要排队
+            # 断点续传日志；预分配模式下还要打开目标文件
+            self.__fd = None
+            self.journal = Journal(self.__get_journal_filename(), self.file_size, self.etag or self.last_modified,
+                                   before_flush=self.__sync_target)
+            if not self.accept_ranges:  # 不支持 Range 就没法从中间续传
+                self.journal.reset()
+            if manifest is not None and self.accept_ranges:
+                self.manifest = self.__load_manifest(manifest)
+            # 有清单时每块写齐了就读回来核对，坏的只重下那一块
+            self.__chunk_starts = []
+            self.__unverified = set()  # 还没核对过的块
+            self.__verify_failures = {}  # 块 -> 核对失败的次数
+            if self.manifest is not None:
+                offset = 0
+                for length, _ in self.manifest["chunks"]:
+                    self.__chunk_starts.append(offset)
+                    offset += length
+                self.__unverified = set(range(len(self.__chunk_starts)))
+            seeds = list(seeds) + [os.path.join(self.download_dir, self.filename)]  # 目标位置上的多半是上个版本
+            if self.preallocate:
+                if self.manifest is not None:
+                    seeds[-1] = self.__set_aside_old_version()
+                self.__open_target()
+            elif self.journal.stale:  # 缓存是远端旧版本的，不能再当成新版本的进度导入
+                for filename in self.__get_cache_filenames():
+                    os.remove(filename)
+            elif not self.journal.resumed and self.accept_ranges:
+                self.__import_legacy_cache()
+            if self.manifest is not None and self.journal.done_bytes == 0:
+                self.__seed_from_local(seeds)
+            if self.hashes:
+                self.__start_hasher()
             # 分块下载
             self.startdlsince = time.time()
-            self.workers = []  # 装载 DLWorker
+            self.__drained = threading.Event()  # 没有 worker 在跑时置位，stop 等它而不是轮询
+            self.__drained.set()
+            self.__stopping = False  # stop 期间回调里不再招新 worker
+            self.__multirange = self.engine == "thread" and self.accept_ranges  # 还没发现服务器不支持多段 Range
+            self.coordinator = coordinator  # (host, port)：同时把区间租给远程 worker（RemoteWorker）
+            self.__coordinator_server = None
+            self.__leases = {}  # 租约号 -> RangeLease
+            self.__lease_demand = 0  # 为远程 worker 请别人 help、还没分出来的次数
+            self.__base_size = self.journal.done_bytes  # 本次启动前已有的字节
+            self.__finished_size = 0  # 本次启动后已结束的 worker 收到的字节
             self.AAEK = self.__get_AAEK_from_cache()  # 需要确定 self.file_size 和 self.block_num
             # 测速
             self.__done = threading.Event()
             self.__download_record = []
-            threading.Thread(target=self.__supervise).start()
+            self.__last_active = {}  # worker -> (最后一次有进展的时间, 当时的 received)
+            # 不支持 Range 时只能一个连接从头下到尾
+            self.controller = ConcurrencyController(self.host, blocks_num) if self.accept_ranges else \
+                ConcurrencyController(self.host, 1, maximum=1)
+            self.__last_tick = time.time()
+            self.__last_received = {}
+            if self.engine == "async":
+                self.__async_pool = AsyncConnectionPool(maxsize=ConcurrencyController.MAXIMUM)
             # 主进程信号，直到下载结束后解除
             self.__main_thread_done = threading.Event()
+            self.__started = False
+            self.__stream_frontier = None  # 有人在 stream 时，读到了哪里
             # 显示基本信息
             readable_size = self.__get_readable_size(self.file_size)
             pathfilename = os.path.join(self.download_dir, self.filename)
+            # 到这里还没有起任何线程（督导、事件循环都在 start 里才起来），构造完就丢掉的也不会留下线程
+            self.__setup_seconds = time.time() - created
+        # 远端“变了”多半是探测缓存过期了：重新探测，从头再下。重建时最后才清掉，stream 在这之前一直等着
+        self.__retry = False
+
+    def __get_session(self):
+        """keep-alive 连接池，大小与并发数上限相当（并发数由 ConcurrencyController 在 blocks_num 附近调整）。"""
+        requests = import_requests()
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=ConcurrencyController.MAXIMUM, pool_block=False)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def get_pool_stats(self):
+        """连接池复用情况：hits 为复用已有连接的请求数，misses 为新建连接数"""
+        hits, misses = 0, 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                misses += pool.num_connections
+                hits += pool.num_requests - pool.num_connections
+        if self.engine == "async" and not self.__bad_url_flag:
+            hits += self.__async_pool.hits
+            misses += self.__async_pool.misses
+        return {"hits": hits, "misses": misses}
 
     def __get_size(self):
         try:
@@ -118,15 +2037,284 @@ class D2wnloader:
             # content_length = req.headers["Content-Length"]
             # req.close()
             # return int(content_length)
-            headers = {'User-Agent': self.user_agent}
-            req = requests.get(self.url, headers=headers, stream=True)
-            content_length = req.headers["Content-Length"]
-            req.close()
-            return int(content_length)
+            info = self.__probe(self.url)
+            self.final_url = info["url"]
+            self.etag = info["etag"]
+            self.last_modified = info["last_modified"]
+            self.accept_ranges = info["accept_ranges"]
+            return info["size"]
         except Exception as err:
             self.__bad_url_flag = True
             self.__whistleblower(f"[Error] {err}")
+            self.__report_end("bad_url", error=str(err))
+            return 0
+
+    def __probe(self, url):
+        """探测大小、是否支持 Range、ETag/Last-Modified 和跳转之后的地址。
+        先查缓存；再试 HEAD；HEAD 不可用或没说支不支持 Range 时，用 Range: bytes=0-0 的 GET 确认"""
+        import requests
+        began = time.time()
+        info = self.probe_cache.get(url)
+        if info is not None:
+            self.__probe_cached = self.__probe_cached or url == self.url
+            self.__report_probe(url, began, cached=True)
+            return info
+        headers = {'User-Agent': self.user_agent, 'Accept-Encoding': 'identity'}
+        info = None
+        try:
+            req = self.session.head(url, headers=headers, allow_redirects=True, timeout=DLWorker.TIMEOUT)
+            accept_ranges = req.headers.get("Accept-Ranges", "").strip().lower()
+            if 200 <= req.status_code <= 299 and "Content-Length" in req.headers:
+                info = {"url": req.url, "size": int(req.headers["Content-Length"]),
+                        "etag": req.headers.get("ETag", ""), "last_modified": req.headers.get("Last-Modified", ""),
+                        "accept_ranges": {"bytes": True, "none": False}.get(accept_ranges)}
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        if info is None or info["accept_ranges"] is None:
+            req = self.session.get(info["url"] if info else url, headers=dict(headers, Range="bytes=0-0"),
+                                   stream=True, timeout=DLWorker.TIMEOUT)
+            try:
+                if req.status_code == 206:
+                    size = int(req.headers["Content-Range"].split("/")[-1])
+                elif 200 <= req.status_code <= 299:
+                    size = int(req.headers["Content-Length"])
+                else:
+                    raise requests.exceptions.HTTPError(f"{req.status_code} {req.reason}")
+                info = {"url": req.url, "size": size, "etag": req.headers.get("ETag", ""),
+                        "last_modified": req.headers.get("Last-Modified", ""), "accept_ranges": req.status_code == 206}
+            finally:
+                req.close()
+        self.probe_cache.put(url, info)
+        self.__report_probe(url, began, cached=False)
+        return info
+
+    def __report_probe(self, url, began, cached):
+        if self.metrics is not None:
+            seconds = time.time() - began
+            self.metrics.observe("d2l_probe_seconds", seconds, cached=str(cached).lower())
+            self.metrics.event("probe", self.filename, start=began, seconds=seconds, url=url, cached=cached)
+
+    def __check_mirrors(self, mirrors):
+        """逐个确认镜像上的是同一个文件，对不上的丢掉"""
+        import requests
+        accepted = []
+        if self.__bad_url_flag:
+            return accepted
+        for url in mirrors:
+            if url == self.url:
+                continue
+            try:
+                info = self.__probe(url)
+            except (requests.exceptions.RequestException, KeyError, ValueError) as err:
+                sys.stdout.write(f"[mirror] {url} dropped: {err}\n")
+                continue
+            if info["size"] != self.file_size or (info["etag"] and self.etag and info["etag"] != self.etag):
+                sys.stdout.write(f"[mirror] {url} dropped: size/ETag mismatch\n")
+                continue
+            if not info["accept_ranges"] or not self.accept_ranges:
+                sys.stdout.write(f"[mirror] {url} dropped: no Range support\n")
+                continue
+            if info["url"] not in accepted and info["url"] != self.final_url:
+                accepted.append(info["url"])
+        return accepted
+
+    def get_mirror_stats(self):
+        """各镜像的 {"speed": 单连接吞吐量, "failures": 连续失败次数, "demoted": 是否降级中}"""
+        return self.mirror_pool.get_stats() if self.mirror_pool is not None else {}
+
+    def __pick_url(self, exclude=None):
+        if self.mirror_pool is None:
+            return self.final_url
+        active = {}
+        for w in list(self.workers):
+            active[w.url] = active.get(w.url, 0) + 1
+        return self.mirror_pool.pick(active, exclude=exclude)
+
+    def __load_manifest(self, manifest):
+        """清单可以是 dict、本地路径或 URL。大小对不上（不是这个版本的清单）就不用"""
+        import hashlib
+        import requests
+        try:
+            if isinstance(manifest, str) and re.match(r"https?://", manifest):
+                req = self.session.get(manifest, headers={'User-Agent': self.user_agent}, timeout=DLWorker.TIMEOUT)
+                req.raise_for_status()
+                manifest = req.json()
+            elif isinstance(manifest, str):
+                with open(manifest) as f:
+                    manifest = json.load(f)
+            hashlib.new(manifest["hash"])
+            if manifest["size"] != self.file_size or sum(length for length, _ in manifest["chunks"]) != self.file_size:
+                raise ValueError("size mismatch")
+        except (requests.exceptions.RequestException, OSError, ValueError, KeyError, TypeError) as err:
+            sys.stdout.write(f"[delta] manifest ignored: {err}\n")
+            return None
+        return manifest
+
+    def __set_aside_old_version(self):
+        """预分配模式下目标文件会被截断重建：上个版本先挪到 .d2s 当种子，下完再删"""
+        pathfilename = os.path.join(self.download_dir, self.filename)
+        aside = pathfilename + ".d2s"
+        if self.journal.resumed and os.path.exists(pathfilename) and os.path.getsize(pathfilename) == self.file_size:
+            return aside  # 续传：目标文件里已经是新内容了，.d2s 是上次挪开的（如果有）
+        if os.path.isfile(pathfilename):
+            os.replace(pathfilename, aside)
+            self.chunk_index.rename(pathfilename, aside)
+        return aside
+
+    def __seed_from_local(self, seeds):
+        """照清单找本地已有的块：索引里登记过的文件，加上 seeds（没登记过的先切块登记）。
+        找到的块拷进缓存文件（预分配模式下直接写进目标文件）、记进日志，AAEK 里只剩变了的部分"""
+        import hashlib
+        algorithm = self.manifest["hash"]
+        for path in seeds:
+            if os.path.isfile(path) and not self.chunk_index.has(path, algorithm):
+                self.chunk_index.index_file(path, algorithm)
+        known = self.chunk_index.lookup(algorithm)
+        files = {}
+        run_start, run_file = None, None  # 正在拷贝的一段连续的块
+        offset, copied = 0, 0
+        try:
+            for i, (length, digest) in enumerate(self.manifest["chunks"] + [[0, None]]):  # 最后补一个空块，收尾最后一段
+                data = None
+                if digest in known:
+                    path, seed_offset, _ = known[digest]
+                    if path not in files:
+                        files[path] = open(path, "rb")
+                    files[path].seek(seed_offset)
+                    data = files[path].read(length)
+                    if hashlib.new(algorithm, data).hexdigest() != digest:  # 种子文件被改过
+                        data = None
+                if data is None and run_start is not None:
+                    if run_file is not None:
+                        run_file.flush()
+                        os.fsync(run_file.fileno())  # 先落盘再记日志
+                        run_file.close()
+                        run_file = None
+                    self.journal.record(run_start, offset - 1)
+                    run_start = None
+                if data is not None:
+                    if run_start is None:
+                        run_start = offset
+                        if not self.preallocate:
+                            run_file = open(f"{self.cache_dir}{self.filename}.{offset}.d2l", "wb")
+                    if self.preallocate:
+                        pwrite(self.__fd, data, offset)
+                    else:
+                        run_file.write(data)
+                    copied += length
+                    self.__unverified.discard(i)  # 拷贝时已经核对过
+                offset += length
+        finally:
+            for f in files.values():
+                f.close()
+            if run_file is not None:
+                run_file.close()
+        self.journal.flush()
+        sys.stdout.write(f"[delta] {self.__get_readable_size(copied)} of {self.__get_readable_size(self.file_size)}"
+                         f" copied from local files\n")
+
+    VERIFY_RETRIES = 3  # 同一块重下这么多次还对不上，多半是清单本身不对，不再重下
+
+    def __verify_chunks(self, spans=None):
+        """清单里已经完整写好、还没核对过的块（只看和 spans 有重叠的；None 表示全部），读回来核对摘要。
+        对不上的块从日志里划掉、交回 AAEK 重下，别的部分不动。返回坏块的个数"""
+        if not self.__unverified:
+            return 0
+        if spans is None:
+            candidates = set(self.__unverified)
+        else:
+            candidates = set()
+            for start, end, _ in spans:
+                lo = max(bisect.bisect_right(self.__chunk_starts, start) - 1, 0)
+                hi = bisect.bisect_right(self.__chunk_starts, end)
+                candidates.update(i for i in range(lo, hi) if i in self.__unverified)
+        if not candidates:
             return 0
+        done = IntervalSet(self.journal.ranges())
+        import hashlib
+        algorithm = self.manifest["hash"]
+        bad = 0
+        for i in sorted(candidates):
+            length, digest = self.manifest["chunks"][i]
+            start, end = self.__chunk_starts[i], self.__chunk_starts[i] + length - 1
+            block = done.find(start)
+            if block is None or block[1] < end:
+                continue  # 还没下齐
+            if hashlib.new(algorithm, self.__read_back(start, end)).hexdigest() == digest:
+                self.__unverified.discard(i)
+                continue
+            self.__verify_failures[i] = self.__verify_failures.get(i, 0) + 1
+            if self.__verify_failures[i] > self.VERIFY_RETRIES:
+                sys.stdout.write(f"\r[verify] bytes {start}-{end} never match the manifest, kept as is\n")
+                self.__unverified.discard(i)
+                continue
+            sys.stdout.write(f"\r[verify] bytes {start}-{end} corrupted, downloading them again\n")
+            self.__requeue(start, end)
+            done = IntervalSet(self.journal.ranges())
+            bad += 1
+        return bad
+
+    def __read_back(self, start, end):
+        """从缓存文件（或目标文件）里读回 [start, end]"""
+        out = bytearray()
+        offset = start
+        while offset <= end:
+            located = self.__locate(offset)
+            if located is None:
+                break
+            path, file_start, last = located
+            with open(path, "rb", buffering=0) as f:  # 不带缓冲，免得读到写入之前预读的旧内容
+                f.seek(offset - file_start)
+                data = f.read(min(end, last) - offset + 1)
+            if not data:
+                break
+            out += data
+            offset += len(data)
+        return bytes(out)
+
+    def __requeue(self, start, end):
+        """[start, end] 重下：从日志里划掉、交回 AAEK。缓存模式下跨过 end 的缓存文件，
+        后半截挪到以 end + 1 命名的新缓存文件里，不用跟着重下"""
+        cut_end = end
+        if not self.preallocate:
+            tails = [(s, e) for s, e in self.journal.ranges() if s <= end < e]
+            if tails:
+                s, e = max(tails, key=lambda t: t[1])
+                busy = {w.range_start for w in list(self.workers)}
+                if end + 1 in busy:
+                    cut_end = e  # 新缓存文件会和正在跑的 worker 撞名，后半截也一起重下
+                elif self.journal.entries.get(end + 1, end) < e:
+                    with open(f"{self.cache_dir}{self.filename}.{s}.d2l", "rb") as src, \
+                            open(f"{self.cache_dir}{self.filename}.{end + 1}.d2l", "wb") as dst:
+                        src.seek(end + 1 - s)
+                        for data in iter(lambda: src.read(1024 * 1024), b""):
+                            dst.write(data)
+                        dst.flush()
+                        os.fsync(dst.fileno())  # 先落盘再改日志
+        self.journal.cut(start, cut_end)
+        self.AAEK.add(start, cut_end)
+        if self.hasher is not None:
+            self.hasher.forget(start, cut_end)
+
+    def __rehash(self):
+        """有块没通过核对时坏数据可能已经算进了摘要：组装好以后把整个文件读一遍重算"""
+        if self.hasher is None or not self.hasher.invalid:
+            return
+        self.hasher = FrontierHasher(self.hashes, self.file_size)
+        offset = 0
+        with open(os.path.join(self.download_dir, self.filename), "rb") as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                self.hasher.feed(offset, data)
+                offset += len(data)
+
+    def __register_chunks(self):
+        """下完的文件登记进块索引，下个版本就能从它拷贝；挪开的上个版本可以删了"""
+        if self.manifest is None:
+            return
+        pathfilename = os.path.join(self.download_dir, self.filename)
+        self.chunk_index.add(pathfilename, self.manifest["chunks"], self.manifest["hash"])
+        if os.path.exists(pathfilename + ".d2s"):
+            os.remove(pathfilename + ".d2s")
 
     def __get_readable_size(self, size):
         units = ["B", "KB", "MB", "GB", "TB", "PB"]
@@ -137,10 +2325,100 @@ class D2wnloader:
             unit_index += 1
         return "%.1f %s" % (size, units[unit_index])
 
+    def __get_journal_filename(self):
+        if self.preallocate:
+            return os.path.join(self.download_dir, self.filename + ".d2j")
+        return f"{self.cache_dir}{self.filename}.d2j"
+
+    def __open_target(self):
+        """打开（或新建并预分配）目标文件。日志与目标文件都对得上才续传，否则从头开始。"""
+        pathfilename = os.path.join(self.download_dir, self.filename)
+        flags = os.O_RDWR | getattr(os, "O_BINARY", 0)
+        if self.journal.resumed and os.path.exists(pathfilename) and os.path.getsize(pathfilename) == self.file_size:
+            self.__fd = os.open(pathfilename, flags)
+            return
+        self.journal.reset()
+        self.__fd = os.open(pathfilename, flags | os.O_CREAT | os.O_TRUNC, 0o666)  # 权限和 open() 新建的一样，再按 umask 去掉
+        if hasattr(os, "posix_fallocate") and self.file_size > 0:
+            try:
+                os.posix_fallocate(self.__fd, 0, self.file_size)
+            except OSError:  # 有些文件系统不支持，退回到 truncate
+                os.ftruncate(self.__fd, self.file_size)
+        else:
+            os.ftruncate(self.__fd, self.file_size)
+
+    def __start_hasher(self):
+        """预分配模式下可以从目标文件读回乱序到达的数据；缓存模式下剩下的部分在 __sew 里边拼边算"""
+        reader = None
+        if self.preallocate:
+            # 不带缓冲：带缓冲的话 seek 回预读过的位置会读到写入之前的旧内容
+            target = open(os.path.join(self.download_dir, self.filename), "rb", buffering=0)
+
+            def reader(offset, n):
+                target.seek(offset)  # 同一时刻只有拿着接力棒的线程会读
+                return target.read(n)
+
+            self.__hash_reader = target
+        self.hasher = FrontierHasher(self.hashes, self.file_size, reader=reader)
+        if self.preallocate:
+            for start, end in self.__get_ranges_from_cache():  # 续传前就有的部分
+                self.hasher.written.add(start, end)
+
+    def hexdigests(self):
+        """边下边算的摘要 {算法: 摘要}；没开或还没算完时返回 None"""
+        return self.hasher.hexdigests() if self.hasher is not None else None
+
+    def __sync_target(self):
+        """日志落盘之前，先让它记下的数据落盘：预分配模式 fsync 目标文件；缓存模式 fsync 还在跑的 worker 的缓存文件
+        （结束了的 worker 关文件前已经 fsync 过）"""
+        if self.__fd is not None:
+            os.fsync(self.__fd)
+            return
+        for w in list(self.workers):
+            for _, _, cache_filename in w.get_spans():
+                try:
+                    fd = os.open(cache_filename, os.O_RDWR)  # Windows 上只读的句柄不能 fsync
+                except OSError:
+                    continue
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+    def __checkpoint(self):
+        """把还在跑的 worker 的进度也记进日志，被杀掉、断电之后能从这里续传。curser 只在写完（交给系统）之后才前进，
+        日志 fsync 之前 __sync_target 会先把数据 fsync 掉，记下的都是真正落了盘的。
+        日志自己会攒批 fsync，这里调用得再频繁也没关系。"""
+        for w in list(self.workers):
+            for start, end, _ in w.get_spans():
+                self.journal.record(start, end)
+
+    def get_downloaded_size(self):
+        """已下载字节数：启动前的 + 已结束 worker 的 + 正在跑的 worker 的计数器，不碰文件系统"""
+        return self.__base_size + self.__finished_size + sum([w.received for w in list(self.workers)])
+
+    def get_speed(self):
+        """最近一段时间（督导的 LAG_COUNT 次采样）的平均速度，字节/秒"""
+        record = self.__download_record
+        if len(record) < 2 or record[-1]["timestamp"] == record[0]["timestamp"]:
+            return 0.0
+        return (record[-1]["size"] - record[0]["size"]) / (record[-1]["timestamp"] - record[0]["timestamp"])
+
+    def get_worker_speeds(self):
+        """各 worker 的速度，字节/秒"""
+        return {w.name: w.speed for w in list(self.workers)}
+
     def __get_cache_filenames(self):
+        import glob
         return glob.glob(f"{self.cache_dir}{self.filename}.*.d2l")
 
-    def __get_ranges_from_cache(self):
+    def __import_legacy_cache(self):
+        """没有日志时（旧版本留下的缓存），扫描一次缓存文件把进度导入日志"""
+        for start, end in self.__get_ranges_from_legacy_cache():
+            self.journal.record(start, end)
+        self.journal.flush()
+
+    def __get_ranges_from_legacy_cache(self):
         # 形如 ./cache/filename.1120.d2l
         ranges = []
         for filename in self.__get_cache_filenames():
@@ -152,199 +2430,656 @@ class D2wnloader:
         ranges.sort(key=lambda x: x[0])  # 排序
         return ranges
 
+    def __get_ranges_from_cache(self):
+        return self.journal.ranges()
+
     def __get_AAEK_from_cache(self):
-        ranges = self.__get_ranges_from_cache()  # 缓存文件里的数据
-        AAEK = []  # 根据 ranges 和 self.file_size 生成 AAEK
-        if len(ranges) == 0:
-            AAEK.append((0, self.file_size - 1))
-        else:
-            for i, (start, end) in enumerate(ranges):
-                if i == 0:
-                    if start > 0:
-                        AAEK.append((0, start - 1))
-                next_start = self.file_size if i == len(ranges) - 1 else ranges[i + 1][0]
-                if end < next_start - 1:
-                    AAEK.append((end + 1, next_start - 1))
+        AAEK = IntervalSet()  # 根据日志里的 ranges 和 self.file_size 生成 AAEK，ranges 之间可能有重叠
+        curser = 0
+        for start, end in self.__get_ranges_from_cache():
+            if start > curser:
+                AAEK.add(curser, start - 1)
+            curser = max(curser, end + 1)
+        if curser < self.file_size:
+            AAEK.add(curser, self.file_size - 1)
         return AAEK
 
-    def __increase_ranges_slice(self, ranges: list, minimum_size=1024 * 1024):
-        """增加分块数目，小于 minimum_size 就不再分割了"""
-        assert len(ranges) > 0
-        block_size = [end - start + 1 for start, end in ranges]
-        index_of_max = block_size.index(max(block_size))
-        start, end = ranges[index_of_max]
-        halfsize = block_size[index_of_max] // 2
-        if halfsize >= minimum_size:
-            new_ranges = [x for i, x in enumerate(ranges) if i != index_of_max]
-            new_ranges.append((start, start + halfsize))
-            new_ranges.append((start + halfsize + 1, end))
-        else:
-            new_ranges = ranges
-        return new_ranges
-
     def __ask_for_work(self, worker_num: int):
-        """申请工作，返回 [work_range]，从 self.AAEK 中扣除。没工作的话返回 []。"""
+        """申请工作，返回 [work_range]，从 self.AAEK 中扣除。没工作的话返回 []。
+        有 manager 时先申请连接名额，拿到几个就干几份。"""
         assert worker_num > 0
-        task = []
-        aaek_num = len(self.AAEK)
-        if aaek_num == 0:  # 没任务了
+        if not self.accept_ranges:  # 不支持 Range：同一时刻只有一个连接，从头下到尾
+            if self.workers:
+                return []
+            worker_num = 1
+        if len(self.AAEK) == 0:  # 没任务了
             self.__share_the_burdern()
             return []
-        if aaek_num >= worker_num:  # 数量充足，直接拿就行了
-            for _ in range(worker_num):
-                task.append(self.AAEK.pop(0))
-        else:  # 数量不足，需要切割
-            slice_num = worker_num - aaek_num  # 需要分割几次
-            task = self.AAEK  # 这个时候 task 就不可能是 [] 了
-            self.AAEK = []
-            for _ in range(slice_num):
-                task = self.__increase_ranges_slice(task)
-        task.sort(key=lambda x: x[0])
-        return task
+        if self.manager is not None:
+            granted = self.manager.acquire(self, worker_num)
+            if granted == 0:
+                return []
+            task = self.AAEK.take(granted)
+            self.manager.release(self, granted - len(task))  # 没用上的名额还回去
+            return self.__batch(task)
+        # 数量充足，直接拿就行了；数量不足，会切割最大的块
+        return self.__batch(self.AAEK.take(worker_num))
+
+    # 多段 Range：不超过这么大的小洞，最多这么多个合成一个请求
+    BATCH_MAX_BLOCK = 256 * 1024
+    BATCH_MAX_RANGES = 16
+
+    def __batch(self, task):
+        """把申请到的块变成 [[(start, end), ...], ...]，每个列表交给一个 worker。
+        零碎的小洞再从 AAEK 里捎上几个同样小的，合成一个多段请求"""
+        work = []
+        for start, end in task:
+            if self.__multirange and end - start + 1 <= self.BATCH_MAX_BLOCK:
+                more = self.AAEK.take_small(self.BATCH_MAX_RANGES - 1, self.BATCH_MAX_BLOCK)
+                if more:
+                    work.append(sorted([(start, end)] + more))
+                    continue
+            work.append([(start, end)])
+        return work
 
     def __share_the_burdern(self, minimum_size=1024 * 1024):
-        """找出工作最繁重的 worker，调用他的 help。回调函数中会将他的任务一分为二。"""
+        """找出工作最繁重的 worker，调用他的 help。回调函数中会将他的任务一分为二。
+        都小到不能再分了，就给最拖后腿的那个找个替身。
+        租约不 help：远程 worker 要到下次送数据才知道，手上那一块白下了；慢的租约靠对冲"""
         max_size = 0
         max_size_name = ""
         for w in self.workers:
+            if w.twin is not None or w.terminate_flag or isinstance(w, RangeLease):
+                continue
             p = w.get_progress()
             size = p["end"] - p["curser"] + 1
             if size > max_size:
                 max_size = size
                 max_size_name = w.name
+        if not self.accept_ranges:
+            return  # 没法分
+        if self.__stream_frontier is not None:
+            # 有人在按顺序读：先帮离读的位置最近、还能分的那个，而不是最大的那个
+            nearest = [w for w in self.workers if w.twin is None and not w.terminate_flag and
+                       w.range_end - w.range_curser + 1 >= minimum_size and not isinstance(w, RangeLease)]
+            if nearest:
+                min(nearest, key=lambda w: w.range_curser).help()
+                return
         if max_size >= minimum_size:
             for w in self.workers:
                 if w.name == max_size_name:
                     w.help()
                     break
+        else:
+            self.__hedge()
+
+    HEDGE_MIN_SECONDS = 1.0  # 预计还要这么久以上才值得找替身
+
+    def __hedge(self):
+        """收尾阶段剩下的块太小、没法再分时，挑预计最后完成的 worker，
+        从他的 curser 开始把剩下的部分再下一遍。谁先下完算谁的，另一个取消。"""
+        now = time.time()
+        candidates = [w for w in list(self.workers) if w.twin is None and not w.terminate_flag and
+                      w.range_curser <= w.range_end and now - w.started_at >= self.HEDGE_MIN_SECONDS]
+        if not candidates:
+            return
+
+        def eta(w):
+            return (w.range_end - w.range_curser + 1) / max(w.speed, 1.0)
+
+        slowest = max(candidates, key=eta)
+        start = slowest.range_curser
+        if eta(slowest) < self.HEDGE_MIN_SECONDS:
+            return
+        if not self.preallocate and start == slowest.range_start:
+            return  # 缓存文件按起始字节命名，会和他撞名；一个字节都没下的连接交给卡住检测去重启
+        if self.manager is not None and self.manager.acquire(self, 1) == 0:
+            return
+        hedge = self.__give_me_a_worker([(start, slowest.range_end)], exclude=slowest.url)
+        hedge.twin = slowest
+        slowest.twin = hedge
+        self.__whip(hedge)
 
     def __give_back_work(self, worker: DLWorker):
-        """接纳没干完的工作。需要按 size 从小到大排序。"""
-        progress = worker.get_progress()
-        curser = progress["curser"]
-        end = progress["end"]
-        if curser <= end:  # 校验一下是否是合理值
-            self.AAEK.append((curser, end))
-            self.AAEK.sort(key=lambda x: x[0])
-
-    def __give_me_a_worker(self, start, end):
+        """接纳没干完的工作，与相邻的未开垦部分合并。双胞胎还在干同一段的话不用交回。"""
+        if worker.twin is not None and worker.twin in self.workers:
+            return
+        if not self.accept_ranges:
+            if worker.get_unfinished():
+                self.AAEK.add(worker.range_start, worker.range_end)  # 没法从中间接着下，只能从头再来
+            return
+        for start, end in worker.get_unfinished():
+            self.AAEK.add(start, end)
+
+    def __give_me_a_worker(self, ranges, exclude=None):
+        """ranges 只有一段时是普通的 worker，有好几段时是多段 Range 的 BatchDLWorker"""
+        url = self.__pick_url(exclude)  # 有镜像时按各镜像的分数挑一个
+        throttle = self.__get_throttle(url)
+        # 镜像的 ETag 可能和主地址的不一样，If-Range 只发给主地址
+        options = dict(if_range=self.if_range if url == self.final_url else None, ranged=self.accept_ranges,
+                       size=self.file_size, throttle=throttle)
+        if len(ranges) > 1:
+            return BatchDLWorker(filename=self.filename, url=url, ranges=ranges, cache_dir=self.cache_dir,
+                                 finish_callback=self.__on_dlworker_finish,
+                                 user_agent=self.user_agent, session=self.session, fd=self.__fd,
+                                 hasher=self.hasher, chunk_size=self.chunk_size, if_range=options["if_range"],
+                                 size=self.file_size, throttle=throttle)
+        start, end = ranges[0]
+        if self.engine == "async":
+            return AsyncDLWorker(name=f"{self.filename}.{start}",
+                                 url=url, range_start=start, range_end=end, cache_dir=self.cache_dir,
+                                 finish_callback=self.__on_dlworker_finish,
+                                 user_agent=self.user_agent, pool=self.__async_pool, fd=self.__fd,
+                                 hasher=self.hasher, chunk_size=self.chunk_size, **options)
         worker = DLWorker(name=f"{self.filename}.{start}",
-                          url=self.url, range_start=start, range_end=end, cache_dir=self.cache_dir,
+                          url=url, range_start=start, range_end=end, cache_dir=self.cache_dir,
                           finish_callback=self.__on_dlworker_finish,
-                          user_agent=self.user_agent)
+                          user_agent=self.user_agent, session=self.session, fd=self.__fd,
+                          hasher=self.hasher, chunk_size=self.chunk_size, **options)
         return worker
 
+    def __get_throttle(self, url):
+        if self.limiter is None:
+            return None
+        host = parse.urlsplit(url).hostname
+        if host not in self.__throttles:
+            self.__throttles[host] = self.limiter.throttle(host, self.rate_bucket, self.priority)
+        return self.__throttles[host]
+
     def __whip(self, worker: DLWorker):
         """鞭笞新来的 worker，让他去工作"""
-        self.workers.append(worker)
-        self.workers.sort()
+        with self.__lock:
+            if self.metrics is not None:  # 时间线上占一条空着的轨道
+                lanes = {w.lane for w in self.workers}
+                worker.lane = next(i for i in range(len(lanes) + 1) if i not in lanes)
+            self.workers.append(worker)
+            self.workers.sort()
+            self.__drained.clear()
         worker.start()
 
     def __on_dlworker_finish(self, worker: DLWorker):
         assert worker.FINISH_TYPE != ""
-        self.workers.remove(worker)
-        if worker.FINISH_TYPE == "HELP":  # 外包
-            self.__give_back_work(worker)
-            self.workaholic(2)
-        elif worker.FINISH_TYPE == "DONE":  # 完工
-            # 再打一份工，也可能打不到
-            self.workaholic(1)
-        elif worker.FINISH_TYPE == "RETIRE":  # 撂挑子
-            # 把工作添加回 AAEK，离职不管了。
-            self.__give_back_work(worker)
-        # 下载齐全，开始组装
-        if self.workers == [] and self.__get_AAEK_from_cache() == []:
-            self.__sew()
+        with self.__lock:
+            self.workers.remove(worker)
+            self.__finished_size += worker.received
+            if self.metrics is not None:
+                self.__report_worker(worker)
+            if worker.remote_changed():
+                self.__on_remote_changed()
+            elif worker.error is not None:
+                sys.stdout.write(f"\r[warn] {worker.name}: {worker.error}\n")
+            if self.__changed:
+                worker.FINISH_TYPE = "CANCEL"  # 已经作废了，什么都不记、不交回
+            for start, end, _ in worker.get_spans() if not self.__changed else []:
+                self.journal.record(start, end)
+            if not self.__changed:
+                self.__verify_chunks(worker.get_spans())
+            if getattr(worker, "multipart", None) is False:
+                self.__multirange = False  # 服务器不支持多段 Range，以后一段一个请求
+            if self.mirror_pool is not None:
+                # 卡住被重启、或者一个字节没拿到就结束（5xx、连不上）算这个镜像的一次失败
+                failed = worker.FINISH_TYPE == "RESTART" or (
+                    worker.FINISH_TYPE == "DONE" and worker.received == 0)
+                self.mirror_pool.report(worker.url, worker.received, time.time() - worker.started_at, not failed)
+            if worker.twin is not None and worker.range_curser > worker.range_end and worker.twin in self.workers:
+                worker.twin.cancel()  # 先下完了，另一个不用干了
+            remote = isinstance(worker, RangeLease)  # 远程 worker 下完会自己来租下一段，不用本地补人
+            if remote:
+                self.__leases.pop(worker.lease_id, None)
+            if worker.FINISH_TYPE == "HELP":  # 外包
+                self.__give_back_work(worker)
+                if self.__lease_demand > 0:
+                    self.__lease_demand -= 1
+                    self.__split_for_lease(worker)
+                else:
+                    self.workaholic(2)
+            elif worker.FINISH_TYPE == "DONE":  # 完工
+                # 连接提前断开时 curser 到不了 end，剩下的交回 AAEK
+                self.__give_back_work(worker)
+                # 再打一份工，也可能打不到。一个字节都没拿到（比如 5xx）就别马上重试了，留给别人或 restart
+                # 有 manager 的话这份工由 manager 决定给谁
+                if worker.received > 0 and self.manager is None and not remote:
+                    self.workaholic(1)
+            elif worker.FINISH_TYPE == "RETIRE":  # 撂挑子
+                # 把工作添加回 AAEK，离职不管了。
+                self.__give_back_work(worker)
+            elif worker.FINISH_TYPE == "RESTART":  # 连接卡住（或者租约过期），换人接着干
+                self.__give_back_work(worker)
+                if not remote:
+                    self.workaholic(1)
+            # CANCEL：双胞胎已经下完了，什么都不用交回
+            if worker.twin is not None:
+                worker.twin.twin = None
+                worker.twin = None
+            if self.workers == []:
+                self.__drained.set()
+                if self.__changed:
+                    self.__discard_after_change()
+            self.__sew_if_complete()
+        if self.manager is not None and not remote:  # 租约的连接在远程 worker 那边，没向 manager 申请过名额
+            # 空出来的连接交给 manager，由离完成最远的下载接手。要在锁外面做，否则两个下载互相等锁
+            # HELP、RESTART 已经在上面 workaholic 里自己申请过名额了，再 dispatch 会一个 help 引出另一个 help
+            self.manager.release(self, 1)
+            if worker.FINISH_TYPE not in ("HELP", "RESTART"):
+                self.manager.dispatch()
+
+    def __report_worker(self, worker: DLWorker):
+        """worker 的计时记进 metrics。时间线上一个 worker 是一段，名字就是它的结局"""
+        seconds = time.time() - worker.started_at
+        metrics, file = self.metrics, self.filename
+        metrics.count("d2l_workers_total", file=file, finish=worker.FINISH_TYPE)
+        metrics.count("d2l_received_bytes_total", worker.received, file=file)
+        metrics.observe("d2l_worker_seconds", seconds, file=file)
+        metrics.observe("d2l_worker_idle_seconds", worker.idle, file=file)
+        ttfb = None
+        if worker.first_byte_at is not None:
+            ttfb = worker.first_byte_at - worker.started_at
+            metrics.observe("d2l_ttfb_seconds", ttfb, file=file)
+        if worker.received:
+            metrics.observe("d2l_connection_throughput_bytes", worker.received / max(seconds, 1e-3), file=file)
+        metrics.event(worker.FINISH_TYPE.lower(), file, track=f"worker {worker.lane}", start=worker.started_at,
+                      seconds=seconds, range=[worker.range_start, worker.range_end], received=worker.received,
+                      status=worker.status, ttfb=ttfb, idle=worker.idle, url=worker.url, error=worker.error)
+
+    def __report_end(self, result, **fields):
+        """一个下载结束了：done、changed 或 bad_url"""
+        if self.metrics is not None:
+            self.metrics.count("d2l_downloads_total", result=result)
+            began = self.__started_at
+            self.metrics.event("download", self.filename, start=began,
+                               seconds=None if began is None else time.time() - began, result=result, **fields)
+
+    def __on_remote_changed(self):
+        """带 Range 的请求收到了 200：If-Range 没对上（远端文件变了），或者服务器不再理会 Range。
+        已经下的部分不能再和新内容拼在一起，全部作废"""
+        if self.__changed:
+            return
+        self.__changed = True
+        if self.__probe_cached:
+            sys.stdout.write(f"\r[info] {self.filename} differs from the cached probe, probing again\n")
+        else:
+            sys.stdout.write(f"\r[Error] {self.filename} changed on the server, progress discarded\n")
+        self.probe_cache.discard(self.url)
+        for w in self.workers:
+            w.cancel()
+
+    def __discard_after_change(self):
+        """最后一个 worker 也结束了：删掉缓存和日志（预分配模式下还有目标文件，里面是新旧混杂、没下到的全是零），
+        下次重新探测、从头下载。大小、ETag 是从探测缓存里拿的话，多半只是缓存过期了，start 会重新探测、从头再下一遍"""
+        self.__done.set()
+        self.__retry = self.__probe_cached
+        if self.hasher is not None and self.preallocate:
+            self.__hash_reader.close()
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+            os.remove(os.path.join(self.download_dir, self.filename))  # Windows 上要先关掉所有句柄才能删
+        self.__stop_serving()
+        self.clear()
+        self.__bad_url_flag = True
+        self.__report_end("changed")
+        self.__main_thread_done.set()
+
+    def __sew_if_complete(self):
+        # 下载齐全，开始组装。AAEK 与日志同步维护，不必再去扫描缓存
+        with self.__lock:
+            if self.workers == [] and len(self.AAEK) == 0 and not self.__stopping and not self.__done.is_set() \
+                    and not self.__changed:
+                if self.__verify_chunks():  # 续传前就有的块还没核对过；有坏的就先重下
+                    self.workaholic(self.controller.target)
+                    return
+                self.journal.flush()
+                self.__sew()
+
+    LEASE_MAX = 64 * 1024 * 1024  # 一次最多租出去这么多，远程 worker 死掉时要重下的也不会太多
+
+    def __serve(self):
+        self.__coordinator_server = make_coordinator_server(self, tuple(self.coordinator))
+        threading.Thread(target=self.__coordinator_server.serve_forever, daemon=True).start()
+        host, port = self.__coordinator_server.server_address[:2]
+        sys.stdout.write(f"[coordinator] http://{host}:{port}\n")
+
+    def __stop_serving(self):
+        """下完了：远程 worker 连不上就会自己退出"""
+        if self.__coordinator_server is not None:
+            self.__coordinator_server.shutdown()  # 由处理请求的线程调用也没关系，serve_forever 在另一个线程里
+            self.__coordinator_server.server_close()
+
+    def grant_lease(self):
+        """给远程 worker 租一段（协调者的 HTTP 接口调用）。AAEK 空了就请最忙的 worker help，分出一半来，
+        让他稍后再来；全部下完（或者不支持 Range、远程帮不上忙）时告诉他收工"""
+        with self.__lock:
+            if self.__done.is_set() or self.__changed or not self.accept_ranges:
+                return {"done": True}
+            if self.__stopping:
+                return {"wait": 1.0}
+            block = self.AAEK.pop_first()  # 从前往后租，stream 的人先拿到
+            if block is None:
+                if self.__lease_demand == 0:
+                    self.__help_for_lease()
+                return {"wait": 0.2}
+            start, end = block
+            if end - start + 1 > self.LEASE_MAX:
+                self.AAEK.add(start + self.LEASE_MAX, end)
+                end = start + self.LEASE_MAX - 1
+            url = self.__pick_url()
+            lease = RangeLease(lease_id=os.urandom(8).hex(), name=f"{self.filename}.{start}", url=url,
+                               range_start=start, range_end=end, cache_dir=self.cache_dir,
+                               finish_callback=self.__on_dlworker_finish, user_agent=self.user_agent,
+                               fd=self.__fd, hasher=self.hasher,
+                               if_range=self.if_range if url == self.final_url else None)
+            self.__leases[lease.lease_id] = lease
+            self.__whip(lease)
+        return {"lease": lease.lease_id, "url": url, "start": start, "end": end, "if_range": lease.if_range}
+
+    def feed_lease(self, lease_id, offset, data):
+        """远程 worker 送回的数据（协调者的 HTTP 接口调用）。返回 False 表示租约已经收回"""
+        lease = self.__leases.get(lease_id)
+        return lease is not None and lease.write(offset, data)
+
+    def release_lease(self, lease_id, status=None):
+        """远程 worker 结束了这段（协调者的 HTTP 接口调用），status 是源站回的状态码"""
+        lease = self.__leases.get(lease_id)
+        if lease is not None:
+            lease.finish(status)
+
+    def __help_for_lease(self, minimum_size=2 * 1024 * 1024):
+        """AAEK 空了，远程 worker 在等活：请剩得最多的 worker help，回调里分出后一半留给远程"""
+        candidates = [w for w in self.workers if w.twin is None and not w.terminate_flag and
+                      w.range_end - w.range_curser + 1 >= minimum_size and type(w) in (DLWorker, AsyncDLWorker)]
+        if candidates:
+            self.__lease_demand += 1
+            max(candidates, key=lambda w: w.range_end - w.range_curser).help()
+
+    def __split_for_lease(self, worker):
+        """交回来的部分本地只接前一半，后一半留在 AAEK 等远程 worker 来租（没人来的话本地 worker 下完会接手）"""
+        for start, end in worker.get_unfinished():
+            half = (end - start + 1) // 2
+            if half == 0 or (self.manager is not None and self.manager.acquire(self, 1) == 0):
+                continue
+            self.AAEK.discard(start, start + half - 1)
+            self.__whip(self.__give_me_a_worker([(start, start + half - 1)]))
+
+    def __expire_leases(self, now):
+        """过期的租约当作卡住处理：restart 交回没下完的部分"""
+        for w in list(self.workers):
+            if isinstance(w, RangeLease) and not w.terminate_flag and now > w.expires:
+                self.__whistleblower(f"\r[info] lease {w.name} expired")
+                w.restart()
 
     def start(self):
         # TODO 尝试整理缓存文件夹内的相关文件
         if not self.__bad_url_flag:
+            began = time.time()
+            self.__started = True
+            self.__started_at = began
+            self.startdlsince = self.__last_tick = began
+            self.__supervisor_gone = threading.Event()
+            if self.engine == "async":
+                get_event_loop().call_soon_threadsafe(self.__supervise_on_loop)
+            else:
+                threading.Thread(target=self.__supervise).start()
+            if self.coordinator is not None and self.__coordinator_server is None:
+                self.__serve()
             # 召集 worker
-            for start, end in self.__ask_for_work(self.blocks_num):
-                worker = self.__give_me_a_worker(start, end)
+            for ranges in self.__ask_for_work(self.controller.target):
+                worker = self.__give_me_a_worker(ranges)
                 self.__whip(worker)
+            self.__sew_if_complete()  # 续传前就已经下齐了（或者全从本地拷到了），不会有回调来组装
+            if self.metrics is not None:
+                # 启动耗时：构造（探测、日志、种子……）加上 start 到第一批 worker 出发，不算两者之间闲着的时间
+                startup = self.__setup_seconds + time.time() - began
+                self.metrics.observe("d2l_startup_seconds", startup, file=self.filename)
+                self.metrics.event("start", self.filename, start=began, size=self.file_size, resumed=self.__base_size,
+                                   engine=self.engine, preallocate=self.preallocate, startup=startup)
             # 卡住主进程
             self.__main_thread_done.wait()
+            if self.__retry:
+                self.__supervisor_gone.wait()  # 旧的督导退出了才能重建
+                self.__init__(**self.__options)  # 探测缓存里的条目已经删了
+                self.start()
+
+    STREAM_POLL = 0.05  # stream 读到还没下好的地方时，多久看一次
+
+    def stream(self, chunk_size=1024 * 1024):
+        """按顺序吐出文件内容的生成器。开头连续的部分一写到盘上就能读到，不必等整个文件下完、组装好。
+        还没 start 的话在后台线程里 start。有人在读时，help 优先分离读的位置最近的 worker。
+        下载失败（比如远端文件中途变了）时抛 IOError，已经吐出去的内容不能再用。"""
+        if self.__bad_url_flag:
+            raise IOError(f"{self.url} is not downloadable")
+        if not self.__started:
+            threading.Thread(target=self.start, daemon=True).start()
+        frontier = 0
+        path, f = None, None
+        try:
+            while frontier < self.file_size:
+                self.__stream_frontier = frontier
+                located = self.__locate(frontier)
+                if located is None:
+                    self.__main_thread_done.wait(self.STREAM_POLL)
+                    continue
+                if located[0] != path:
+                    if f is not None:
+                        f.close()
+                        path, f = None, None
+                    try:
+                        f = open(located[0], "rb", buffering=0)  # 不带缓冲，免得读到预读进来的旧内容
+                    except FileNotFoundError:  # 刚组装完，缓存文件被删了，下一轮会去读目标文件；下载失败的话下一轮抛错
+                        self.__main_thread_done.wait(self.STREAM_POLL)
+                        continue
+                    path = located[0]
+                _, file_start, end = located
+                f.seek(frontier - file_start)
+                data = f.read(min(chunk_size, end - frontier + 1))
+                if not data:
+                    self.__main_thread_done.wait(self.STREAM_POLL)
+                    continue
+                frontier += len(data)
+                yield data
+        finally:
+            self.__stream_frontier = None
+            if f is not None:
+                f.close()
+
+    def __locate(self, offset):
+        """offset 处的数据在哪个文件里：返回 (文件名, 文件开头对应的偏移, 这个文件里连续可读到的最后一个字节)，
+        还没下到返回 None。下载已经失败时抛 IOError"""
+        target = os.path.join(self.download_dir, self.filename)
+        if self.__main_thread_done.is_set():
+            if self.__retry and not self.__stream_frontier:  # 马上要重新探测、从头再下，还没吐出过旧内容的话接着等
+                return None
+            if self.is_bad_url() or not self.is_done():  # 缓存已删，预分配的目标文件里也不是有效数据
+                raise IOError(f"{self.filename} failed to download")
+            return target, 0, self.file_size - 1
+        spans = [span for w in list(self.workers) for span in w.get_spans()]  # 正在下的
+        spans += [(start, end, f"{self.cache_dir}{self.filename}.{start}.d2l") for start, end in self.journal.ranges()]
+        best = None
+        for start, end, cache_filename in spans:
+            if start <= offset <= end and (best is None or end > best[2]):
+                best = (target, 0, end) if self.preallocate else (cache_filename, start, end)
+        return best
 
     def stop(self):
-        for w in self.workers:
-            w.retire()
-        while len(self.workers) != 0:
-            time.sleep(0.5)
-        self.AAEK = self.__get_AAEK_from_cache()
+        with self.__lock:
+            self.__stopping = True
+            for w in self.workers:
+                w.retire()
+        self.__drained.wait()  # 最后一个 worker 的回调结束时就会放行
+        with self.__lock:
+            self.__stopping = False
+            self.journal.flush()
+            self.AAEK = self.__get_AAEK_from_cache()
 
     def workaholic(self, n=1):
         """九九六工作狂。如果能申请到，就地解析；申请不到，__give_me_a_worker 会尝试将一个 worker 的工作一分为二；"""
-        for s, e in self.__ask_for_work(n):
-            worker = self.__give_me_a_worker(s, e)
+        if self.__stopping or self.__done.is_set():
+            return 0
+        task = self.__ask_for_work(n)
+        for ranges in task:
+            worker = self.__give_me_a_worker(ranges)
             self.__whip(worker)
+        return len(task)
+
+    def get_progress(self):
+        """完成比例，0 到 1"""
+        return self.get_downloaded_size() / self.file_size if self.file_size else 1.0
+
+    def is_done(self):
+        return self.__done.is_set() and not self.__changed
+
+    def is_bad_url(self):
+        return self.__bad_url_flag
 
     def restart(self):
         self.stop()
         # 再次召集 worker。不调用 start 的原因是希望他继续卡住主线程。
-        for start, end in self.__ask_for_work(self.blocks_num):
-            worker = self.__give_me_a_worker(start, end)
+        for ranges in self.__ask_for_work(self.controller.target):
+            worker = self.__give_me_a_worker(ranges)
             self.__whip(worker)
+        self.__sew_if_complete()  # stop 期间最后一个 worker 恰好完工的话，没有回调会来组装了
+
+    # 督导的参数
+    REFRESH_INTERVAL = 0.25  # 每多久输出一次监视状态。只读计数器，不碰文件系统，可以很频繁
+    LAG_COUNT = 40  # 计算过去多少次测量的平均速度
+    STALL_SECONDS = 5  # 多久一个字节都没收到就算卡住
+    SLOW_RATIO = 0.1  # 比其他 worker 的中位数慢这么多也算卡住
 
     def __supervise(self):
         """万恶的督导：监视下载速度、进程数；提出整改意见；"""
-        REFRESH_INTERVAL = 1  # 每多久输出一次监视状态
-        LAG_COUNT = 10  # 计算过去多少次测量的平均速度
-        WAIT_TIMES_BEFORE_RESTART = 30  # 乘以时间就是等待多久执行一次 restart
-        SPEED_DEGRADATION_PERCENTAGE = 0.5  # 速度下降百分比
-        self.__download_record = []
-        maxspeed = 0
-        wait_times = WAIT_TIMES_BEFORE_RESTART
         while not self.__done.is_set():
-            dwn_size = sum([os.path.getsize(cachefile) for cachefile in self.__get_cache_filenames()])
-            self.__download_record.append({"timestamp": time.time(), "size": dwn_size})
-            if len(self.__download_record) > LAG_COUNT:
-                self.__download_record.pop(0)
-            s = self.__download_record[-1]["size"] - self.__download_record[0]["size"]
-            t = self.__download_record[-1]["timestamp"] - self.__download_record[0]["timestamp"]
-            if not t == 0:
-                speed = s / t
-                readable_speed = self.__get_readable_size(speed)  # 变成方便阅读的样式
-                percentage = self.__download_record[-1]["size"] / self.file_size * 100
-                status_msg = f"\r[info] {percentage:.1f} % | {readable_speed}/s | {len(self.workers)}+{threading.active_count() - len(self.workers)} {(time.time() - self.startdlsince):.0f}s"
-                self.__whistleblower(status_msg)
-                # 监测下载速度下降
-                maxspeed = max(maxspeed, speed)
-                EPSILON = 1e-5  # 表示很小的值，避免除以零
-                # 构建几个表达式用于简化逻辑，首先是前提条件
-                time_over = wait_times < 0  # 容忍时间到了
-                not_finished = not self.__done.is_set()  # 尚未完成下载
-                # 情况 1. 速度在 1MB/s 以下，并且下降明显（如果速度在 1MB/s 以上可以先不管）
-                speed_drops_significantly = (maxspeed - speed + EPSILON) / (maxspeed + EPSILON) > SPEED_DEGRADATION_PERCENTAGE
-                speed_under_threshold = speed < 1024 * 1024  # 1MB
-                scene_1 = speed_drops_significantly and speed_under_threshold
-                # 情况 2. 速度很慢
-                scene_2 = speed < 16 * 1024  # 16KB
-                if time_over and not_finished and (scene_1 or scene_2):
-                    self.__whistleblower("\r[info] speed degradation, restarting...")
-                    self.restart()
-                    maxspeed = 0
-                    wait_times = WAIT_TIMES_BEFORE_RESTART
-                else:
-                    wait_times -= 1
-            time.sleep(REFRESH_INTERVAL)
+            self.__supervise_tick()
+            self.__done.wait(self.REFRESH_INTERVAL)
+        self.__supervisor_gone.set()
+
+    def __supervise_on_loop(self):
+        """async 引擎下督导由事件循环定时触发，不再单独占一个线程。每一轮都要记日志（会 fsync）
+        放到线程池里跑，跑完再约下一轮，不卡事件循环"""
+        if not self.__done.is_set():
+            loop = get_event_loop()
+            tick = loop.run_in_executor(None, self.__supervise_tick)
+            tick.add_done_callback(lambda _: loop.call_later(self.REFRESH_INTERVAL, self.__supervise_on_loop))
+        else:
+            self.__supervisor_gone.set()
+
+    def __supervise_tick(self):
+        self.__checkpoint()
+        now = time.time()
+        # 各 worker 的速度，指数平滑
+        for w in list(self.workers):
+            dt = now - self.__last_tick
+            if dt > 0:
+                w.speed = 0.5 * w.speed + 0.5 * (w.received - self.__last_received.get(w, 0)) / dt
+                if w.received == self.__last_received.get(w, 0):
+                    w.idle += dt
+            self.__last_received[w] = w.received
+        self.__last_received = {w: n for w, n in self.__last_received.items() if w in self.workers}
+        self.__last_tick = now
+        dwn_size = self.get_downloaded_size()
+        tick_speed = 0.0
+        if self.__download_record and now > self.__download_record[-1]["timestamp"]:
+            tick_speed = (dwn_size - self.__download_record[-1]["size"]) / (now - self.__download_record[-1]["timestamp"])
+        self.__download_record.append({"timestamp": now, "size": dwn_size})
+        if self.metrics is not None:
+            self.metrics.gauge("d2l_downloaded_bytes", dwn_size, file=self.filename)
+            self.metrics.gauge("d2l_workers", len(self.workers), file=self.filename)
+            self.metrics.sample("downloaded", self.filename, bytes=dwn_size)
+            self.metrics.sample("workers", self.filename, active=len(self.workers), target=self.controller.target)
+        if len(self.__download_record) > self.LAG_COUNT:
+            self.__download_record.pop(0)
+        s = self.__download_record[-1]["size"] - self.__download_record[0]["size"]
+        t = self.__download_record[-1]["timestamp"] - self.__download_record[0]["timestamp"]
+        if not t == 0:
+            speed = s / t
+            readable_speed = self.__get_readable_size(speed)  # 变成方便阅读的样式
+            percentage = self.__download_record[-1]["size"] / self.file_size * 100
+            status_msg = f"\r[info] {percentage:.1f} % | {readable_speed}/s | {len(self.workers)}/{self.controller.target} {(time.time() - self.startdlsince):.0f}s"
+            self.__whistleblower(status_msg)
+        if self.__done.is_set() or self.__stopping:
+            return
+        self.__restart_stalled_worker(now)
+        self.__expire_leases(now)
+        # 并发数交给控制器：多了就让最慢的退休，少了就多招人。租约不算，远程 worker 有几个线程由他们自己定
+        target = self.controller.update(tick_speed)
+        workers = [w for w in list(self.workers) if not w.terminate_flag and not isinstance(w, RangeLease)]
+        if len(workers) > target:
+            min(workers, key=lambda w: w.speed).retire()
+        elif len(workers) < target:  # 没有未开垦的部分时 workaholic 只会请一个人帮忙分担
+            self.workaholic(target - len(workers))
+
+    def __restart_stalled_worker(self, now):
+        """只重启卡住的那一个连接，其他连接不受影响。每次最多一个，避免误判时全军覆没。"""
+        workers = [w for w in list(self.workers) if not w.terminate_flag and not isinstance(w, RangeLease)]
+        for w in workers:
+            if w not in self.__last_active or self.__last_received.get(w) != self.__last_active[w][1]:
+                self.__last_active[w] = (now, self.__last_received.get(w, 0))
+        self.__last_active = {w: v for w, v in self.__last_active.items() if w in self.workers}
+        speeds = sorted([w.speed for w in workers])
+        median = speeds[len(speeds) // 2] if speeds else 0
+        for w in workers:
+            idle = now - self.__last_active[w][0]
+            age = now - w.started_at
+            too_slow = age > self.STALL_SECONDS and median > 64 * 1024 and w.speed < median * self.SLOW_RATIO
+            if idle > self.STALL_SECONDS or too_slow:
+                self.__whistleblower(f"\r[info] {w.name} stalled, restarting...")
+                if self.metrics is not None:
+                    self.metrics.count("d2l_stalls_total", file=self.filename)
+                    self.metrics.event("stall", self.filename, track=f"worker {w.lane}", idle=idle, speed=w.speed)
+                w.restart()
+                return
 
     def __sew(self):
         self.__done.set()
+        began = time.time()
+        if self.preallocate:  # 数据早已各就各位，不需要拼接
+            if self.hasher is not None:
+                if not self.hasher.invalid:
+                    self.hasher.drain()  # 通常早已算完，只剩续传前就有的部分要读
+                self.__hash_reader.close()
+            os.close(self.__fd)
+            self.__fd = None
+            self.__stop_serving()
+            self.__rehash()
+            self.__register_chunks()
+            self.clear()
+            self.__whistleblower("\r")
+            self.__report_sew(began)
+            self.__main_thread_done.set()
+            return
         chunk_size = 10 * 1024 * 1024
         with open(f"{os.path.join(self.download_dir, self.filename)}", "wb") as f:
-            for start, _ in self.__get_ranges_from_cache():
+            written = 0  # 日志里的 ranges 可能重叠，只拷贝还没写过的部分
+            for start, end in self.__get_ranges_from_cache():
+                if end < written:
+                    continue
                 cache_filename = f"{self.cache_dir}{self.filename}.{start}.d2l"
                 with open(cache_filename, "rb") as cache_file:
-                    data = cache_file.read(chunk_size)
+                    cache_file.seek(written - start if written > start else 0)
+                    remain = end - max(start, written) + 1
+                    position = max(start, written)
+                    data = cache_file.read(min(chunk_size, remain))
                     while data:
                         f.write(data)
-                        f.flush()
-                        data = cache_file.read(chunk_size)
+                        if self.hasher is not None:
+                            self.hasher.feed(position, data)  # 前沿之前的部分会被跳过
+                        position += len(data)
+                        remain -= len(data)
+                        data = cache_file.read(min(chunk_size, remain)) if remain > 0 else b""
+                written = end + 1
+        self.__stop_serving()
+        self.__rehash()
+        self.__register_chunks()
         self.clear()
         self.__whistleblower("\r")
+        self.__report_sew(began)
         self.__main_thread_done.set()
 
+    def __report_sew(self, began):
+        if self.metrics is not None:
+            seconds = time.time() - began
+            self.metrics.observe("d2l_sew_seconds", seconds, file=self.filename)
+            self.metrics.event("sew", self.filename, start=began, seconds=seconds, preallocate=self.preallocate)
+        self.__report_end("done", size=self.file_size)
+
     def __whistleblower(self, saying: str):
         # iPhone 12 mini 每行显示45个字符，等款字体
         # 这里假设 \r 如果出现一定位于字符串的起始
@@ -355,6 +3090,10 @@ class D2wnloader:
             sys.stdout.write(saying + " " * (wordsCountOfEachLine - len(saying.replace("\r", ""))))
 
     def md5(self):
+        digests = self.hexdigests()
+        if digests is not None and "md5" in digests:  # 下载时已经算好了
+            return digests["md5"]
+        import hashlib
         chunk_size = 1024 * 1024
         filename = f"{os.path.join(self.download_dir, self.filename)}"
         md5 = hashlib.md5()
@@ -368,9 +3107,72 @@ class D2wnloader:
     def clear(self):
         for filename in self.__get_cache_filenames():
             os.remove(filename)
+        self.journal.remove()
+
+
+def read_batch_file(path):
+    """批量文件：一行一个 URL，空行和 # 开头的行跳过。path 为 - 时读标准输入"""
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    try:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def main(argv=None):
+    """命令行入口。一个 URL 直接下，好几个（或者 -i 给了批量文件）交给 DLManager 在同一个进程里下，
+    cron 里一次次起进程时，解释器和导入的开销只花一次。全部下完返回 0，有失败的返回 1"""
+    import argparse
+    parser = argparse.ArgumentParser(description="多线程、分块、断点续传的下载器")
+    parser.add_argument("urls", nargs="*", metavar="URL")
+    parser.add_argument("-i", "--input-file", metavar="FILE", help="批量文件，一行一个 URL，- 表示标准输入")
+    parser.add_argument("-d", "--dir", default=f".{os.sep}d2l{os.sep}", help="下载到哪里")
+    parser.add_argument("-n", "--blocks", type=int, default=8, help="初始并发数（blocks_num）")
+    parser.add_argument("--engine", choices=("thread", "async"), default="thread")
+    parser.add_argument("--preallocate", action="store_true", help="预分配目标文件，直接按偏移写入")
+    parser.add_argument("--hash", action="append", default=[], metavar="ALGORITHM",
+                        help="边下边算的摘要，可以给好几次，比如 --hash md5 --hash sha256")
+    parser.add_argument("--mirror", action="append", default=[], metavar="URL", help="同一个文件的镜像，只用于单个 URL")
+    parser.add_argument("--rate-limit", type=int, default=0, metavar="BYTES", help="总限速（字节/秒），0 不限")
+    parser.add_argument("--probe-ttl", type=int, default=ProbeCache.TTL, help="探测缓存多少秒过期，0 不用缓存")
+    parser.add_argument("--max-connections", type=int, default=32, help="批量下载的总连接数上限")
+    parser.add_argument("--per-host", type=int, default=8, help="批量下载时同一主机的连接数上限")
+    parser.add_argument("--max-active", type=int, default=0, help="批量下载时同时进行的下载数，0 表示不另设上限")
+    parser.add_argument("--metrics", metavar="FILE", help="结束时把计数器和直方图写成 Prometheus 文本格式")
+    parser.add_argument("--trace", metavar="FILE", help="结束时把时间线写成 Chrome 的 Trace Event JSON")
+    args = parser.parse_args(argv)
+    urls = list(args.urls) + (read_batch_file(args.input_file) if args.input_file else [])
+    if not urls:
+        parser.error("没有要下载的 URL")
+    if args.mirror and len(urls) > 1:
+        parser.error("--mirror 只能用于单个 URL")
+    metrics = Metrics() if args.metrics or args.trace else None
+    kwargs = dict(blocks_num=args.blocks, engine=args.engine, preallocate=args.preallocate, hashes=args.hash,
+                  probe_ttl=args.probe_ttl, metrics=metrics,
+                  limiter=BandwidthLimiter(args.rate_limit) if args.rate_limit else None)
+    try:
+        if len(urls) == 1:
+            d = D2wnloader(urls[0], download_dir=args.dir, mirrors=args.mirror, **kwargs)
+            d.start()
+            ok = not d.is_bad_url() and d.is_done()
+            if ok:
+                for name, digest in (d.hexdigests() or {}).items():
+                    sys.stdout.write(f"\r[{name}] {digest}\n")
+        else:
+            results = DLManager(urls, download_dir=args.dir, max_connections=args.max_connections,
+                                per_host=args.per_host, max_active=args.max_active, **kwargs).run()
+            ok = all(result == "done" for result in results.values())
+            for url, result in results.items():
+                if result != "done":
+                    sys.stdout.write(f"\r[failed] {url}\n")
+    finally:
+        if args.metrics:
+            metrics.write_prometheus(args.metrics)
+        if args.trace:
+            metrics.write_trace(args.trace)
+    return 0 if ok else 1
 
 
 if __name__ == "__main__":
-    url = "https://qd.myapp.com/myapp/qqteam/pcqq/QQ9.0.8_3.exe"
-    dl = D2wnloader(url)
-    dl.start()
+    sys.exit(main())
@@ -0,0 +1,203 @@
+# coding: utf-8
+"""D2wnloader（以及作为对照的 D1wnloader）的基准测试。
+
+起一个本地的 range_server，按 文件大小 × blocks_num × 实现 逐个下载，每次都在独立的子进程、独立的临时目录里跑，
+记下耗时、吞吐量、CPU 时间和内存峰值，最后写成 JSON，方便不同版本之间 diff。
+另外单独测命令行的启动耗时（解释器、导入、解析参数），cron 里一次次跑很短的下载时这部分占大头。
+
+    python debug/bench.py --sizes 16M,128M --blocks 4,8,16 --impl d1,d2 --out bench.json
+    python debug/bench.py --rate 2097152 --stall 0.05 --error 0.02 --kwargs '{"engine": "async"}'
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import range_server
+
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def child(impl, url, blocks_num, kwargs, result_path):
+    """在子进程里下载一次，把测量结果写到 result_path。工作目录就是这次的临时目录"""
+    import resource
+    sys.path.insert(0, ROOT)
+    began = time.perf_counter()
+    startup = None  # D2wnloader 构造加上 start 到第一批 worker 出发的时间
+    if impl == "d1":
+        from D1wnloader import D1wnloader
+        imported = time.perf_counter()
+        D1wnloader(url, download_dir="./", blocks_num=blocks_num).start()
+        path = os.path.join(".", url.split("/")[-1])
+    else:
+        from D2wnloader import D2wnloader, Metrics
+        imported = time.perf_counter()
+        started = {}
+        metrics = Metrics(on_event=lambda name, fields: started.update(fields) if name == "start" else None)
+        d = D2wnloader(url, blocks_num=blocks_num, metrics=metrics, **kwargs)
+        d.start()
+        path = os.path.join(d.download_dir, d.filename)
+        startup = started.get("startup")
+    seconds = time.perf_counter() - began
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    peak_rss = usage.ru_maxrss if sys.platform != "darwin" else usage.ru_maxrss // 1024  # macOS 上单位是字节
+    with open(result_path, "w") as f:
+        json.dump({"path": os.path.abspath(path), "seconds": seconds, "import_seconds": imported - began,
+                   "startup_seconds": startup, "cpu_seconds": usage.ru_utime + usage.ru_stime,
+                   "peak_rss_kb": peak_rss}, f)
+    sys.stdout.flush()
+    os._exit(0)  # 不等还没退出的非 daemon 线程
+
+
+def file_md5(path):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def run_once(impl, url, size, blocks_num, kwargs, timeout, expected_md5):
+    workdir = tempfile.mkdtemp(prefix="d2l-bench-")
+    result_path = os.path.join(workdir, "result.json")
+    record = {"impl": impl, "size": size, "blocks_num": blocks_num}
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--child", impl, url, str(blocks_num),
+                   json.dumps(kwargs), result_path]
+        try:
+            subprocess.run(command, cwd=workdir, timeout=timeout,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except subprocess.TimeoutExpired:
+            record.update(status="timeout", seconds=timeout)
+            return record
+        if not os.path.exists(result_path):
+            record.update(status="crashed")
+            return record
+        with open(result_path) as f:
+            measured = json.load(f)
+        ok = os.path.exists(measured["path"]) and file_md5(measured["path"]) == expected_md5
+        record.update(status="ok" if ok else "corrupt",
+                      seconds=round(measured["seconds"], 4),
+                      throughput=round(size / measured["seconds"]) if measured["seconds"] else None,
+                      import_seconds=round(measured["import_seconds"], 4),
+                      startup_seconds=round(measured["startup_seconds"], 4)
+                      if measured["startup_seconds"] is not None else None,
+                      cpu_seconds=round(measured["cpu_seconds"], 4),
+                      peak_rss_kb=measured["peak_rss_kb"])
+        return record
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# 启动耗时：每条命令单独起一个解释器，从 fork 到退出
+STARTUP_COMMANDS = {
+    "python": ["-c", "pass"],  # 解释器本身，作为基线
+    "import": ["-c", "import D2wnloader"],
+    "import_requests": ["-c", "import D2wnloader; D2wnloader.import_requests()"],  # 真要下载时还得导入 requests
+    "cli_help": [os.path.join(ROOT, "D2wnloader.py"), "--help"],
+}
+
+
+def measure_startup(runs):
+    """各条命令跑 runs 次，取中位数和最小值（秒）"""
+    results = {}
+    for name, args in STARTUP_COMMANDS.items():
+        times = []
+        for _ in range(runs):
+            began = time.perf_counter()
+            subprocess.run([sys.executable] + args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - began)
+        times.sort()
+        results[name] = {"median": round(times[len(times) // 2], 4), "min": round(times[0], 4)}
+        print(f"startup {name}: {results[name]['median'] * 1000:.1f} ms (min {results[name]['min'] * 1000:.1f} ms)",
+              flush=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="8M,64M", help="逗号分隔，支持 K/M/G")
+    parser.add_argument("--blocks", default="4,8,16", help="逗号分隔的 blocks_num")
+    parser.add_argument("--impl", default="d1,d2", help="d1、d2 或二者")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=300, help="单次下载的超时（秒）")
+    parser.add_argument("--kwargs", default="{}", help="传给 D2wnloader 的其它参数，JSON")
+    parser.add_argument("--out", default=None, help="报告写到哪里，默认只打印")
+    parser.add_argument("--startup-runs", type=int, default=10, help="启动耗时每条命令跑几次，0 不测")
+    range_server.add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    faults = range_server.faults_from_args(args)
+    kwargs = json.loads(args.kwargs)
+    server, root = range_server.start(**faults)
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "faults": faults,
+            "kwargs": kwargs,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "startup": measure_startup(args.startup_runs) if args.startup_runs > 0 else None,
+        "results": [],
+    }
+    try:
+        for size in [parse_size(s) for s in args.sizes.split(",")]:
+            expected = range_server.md5(size)
+            for blocks_num in [int(b) for b in args.blocks.split(",")]:
+                for impl in args.impl.split(","):
+                    for i in range(args.repeat):
+                        record = run_once(impl, f"{root}/{size}.bin", size, blocks_num,
+                                          kwargs if impl == "d2" else {}, args.timeout, expected)
+                        record["repeat"] = i
+                        report["results"].append(record)
+                        throughput = record.get("throughput")
+                        print(f"{impl} size={size} blocks={blocks_num} #{i}: {record['status']} "
+                              f"{record.get('seconds', 0):.2f}s "
+                              f"{throughput / 1024 / 1024 if throughput else 0:.1f} MB/s "
+                              f"cpu={record.get('cpu_seconds', 0):.2f}s rss={record.get('peak_rss_kb', 0)} KB "
+                              f"import={record.get('import_seconds') or 0:.3f}s startup={record.get('startup_seconds') or 0:.3f}s",
+                              flush=True)
+    finally:
+        server.shutdown()
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 7 and sys.argv[1] == "--child":
+        _, _, impl, url, blocks_num, kwargs, result_path = sys.argv
+        child(impl, url, int(blocks_num), json.loads(kwargs), result_path)
+    else:
+        main()
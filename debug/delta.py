@@ -0,0 +1,100 @@
+# coding: utf-8
+"""增量下载（manifest + seeds）的自检：缓存模式、预分配模式、async 引擎各下一遍。
+
+起一个本地的 range_server 当“新版本”，“旧版本”是在新版本上插入、改写、删掉几段得到的本地文件。
+旧版本分别作为 seeds 传进去、或者放在目标位置上；每次都在独立的临时目录里下载，
+检查 md5，以及有多少是从本地拷的。有一项不对退出码就是 1。
+
+    python debug/delta.py --size 1000K
+
+range_server 的内容以 1 MB 左右为周期循环，文件比这大的话改过的块也能在别处找到，看不出下了多少。
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+sys.path.insert(0, ROOT)
+
+import range_server
+from bench import parse_size, file_md5
+from D2wnloader import D2wnloader, make_manifest
+
+CASES = [
+    ("cache", {}),
+    ("preallocate", {"preallocate": True}),
+    ("async", {"engine": "async"}),
+]
+
+
+def old_version(new):
+    """在新版本上动几个地方：插入、改写、删除，各自只影响附近的一两块"""
+    old = bytearray(new)
+    third = len(old) // 3
+    old[third:third] = os.urandom(100)
+    old[2 * third:2 * third + 4096] = os.urandom(4096)
+    del old[-third // 2:-third // 2 + 500]
+    return bytes(old)
+
+
+def run_case(url, size, manifest_path, old_path, kwargs, at_target):
+    workdir = tempfile.mkdtemp(prefix="d2l-delta-")
+    cwd = os.getcwd()
+    os.chdir(workdir)  # 缓存目录和块登记表总在 ./d2l/.cache 下
+    try:
+        download_dir = os.path.join(workdir, "d2l") + os.sep
+        os.makedirs(download_dir)
+        seeds = [old_path]
+        if at_target:  # 上个版本就在目标位置上
+            shutil.copy(old_path, os.path.join(download_dir, f"{size}.bin"))
+            seeds = []
+        d = D2wnloader(url, download_dir=download_dir, manifest=manifest_path, seeds=seeds, probe_ttl=0, **kwargs)
+        copied = d.get_downloaded_size()  # 开始前已有的都是从本地拷的
+        d.start()
+        path = os.path.join(download_dir, f"{size}.bin")
+        ok = d.is_done() and os.path.exists(path) and file_md5(path) == range_server.md5(size)
+        return ok, copied
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", default="1000K", help="文件大小，不要超过 range_server 的循环周期")
+    args = parser.parse_args()
+    size = parse_size(args.size)
+    server, root = range_server.start()
+    url = f"{root}/{size}.bin"
+    tmp = tempfile.mkdtemp(prefix="d2l-delta-src-")
+    try:
+        new_path = os.path.join(tmp, "new.bin")
+        old_path = os.path.join(tmp, "old.bin")
+        with open(new_path, "wb") as f:
+            f.write(range_server.content(0, size))
+        with open(old_path, "wb") as f:
+            f.write(old_version(range_server.content(0, size)))
+        manifest_path = os.path.join(tmp, "new.bin.d2m")
+        with open(manifest_path, "w") as f:
+            json.dump(make_manifest(new_path), f)
+        failed = 0
+        for name, kwargs in CASES:
+            for at_target in (False, True):
+                ok, copied = run_case(url, size, manifest_path, old_path, kwargs, at_target)
+                ok = ok and size // 2 < copied < size  # 只改了几处：绝大部分是拷的，改过的几块要下
+                failed += not ok
+                where = "target" if at_target else "seeds"
+                print(f"\r{name:12} {where:7} copied {copied / size:6.1%}  {'ok' if ok else 'FAILED'}")
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
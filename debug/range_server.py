@@ -0,0 +1,229 @@
+# coding: utf-8
+"""本地测试用的 HTTP 服务器：支持 Range、HEAD、ETag，可以注入延迟、限速、卡死和 5xx。
+
+文件按路径生成：/<字节数>.bin，比如 /104857600.bin。内容只由偏移决定，可以重现，不占磁盘。
+
+    python debug/range_server.py --port 37213 --latency 0.05 --rate 1048576 --stall 0.05 --error 0.02
+
+好几段 Range 按 multipart/byteranges 回复；--no-multipart 时只回第一段，和不少服务器一样。
+--no-ranges 时完全不理会 Range，总是回 200。If-Range 和 ETag 对不上时也回 200。
+也可以在别的脚本里 start() 起一个跑在后台线程里的。
+"""
+import argparse
+import hashlib
+import http.server
+import random
+import re
+import threading
+import time
+
+PERIOD = 1048573  # 内容以这个长度（素数）循环，错位的块几乎不可能碰巧对得上
+PATTERN = random.Random(20210801).randbytes(PERIOD)
+PIECE = 64 * 1024  # 每次发送多少字节，限速和卡死都以此为粒度
+
+
+def content(offset, n):
+    """文件里 [offset, offset + n) 的内容"""
+    out = bytearray()
+    while n > 0:
+        i = offset % PERIOD
+        piece = PATTERN[i:i + n]
+        out += piece
+        offset += len(piece)
+        n -= len(piece)
+    return bytes(out)
+
+
+def md5(size):
+    """一个 size 字节的文件应有的 md5"""
+    h = hashlib.md5()
+    for offset in range(0, size, PERIOD):
+        h.update(content(offset, min(PERIOD, size - offset)))
+    return h.hexdigest()
+
+
+class Faults:
+    """要注入的毛病。概率都是按单个响应计算的"""
+
+    def __init__(self, latency=0.0, rate=0, stall=0.0, stall_seconds=0.0, error=0.0, seed=None):
+        self.latency = latency  # 每个响应在发出响应头之前等多久（秒）
+        self.rate = rate  # 每条连接的限速（字节/秒），0 不限
+        self.stall = stall  # 响应中途卡住的概率
+        self.stall_seconds = stall_seconds  # 卡多久，0 表示卡到客户端断开
+        self.error = error  # 直接回 503 的概率
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def roll(self, p):
+        with self.lock:
+            return self.random.random() < p
+
+    def stall_point(self, n):
+        with self.lock:
+            return self.random.randrange(n) if n > 0 else 0
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    faults = Faults()
+    multipart = True
+    ranges = True
+    BOUNDARY = "D2L_BENCH_BOUNDARY"
+
+    def log_message(self, format, *args):
+        pass
+
+    def __size(self):
+        m = re.fullmatch(r"/(\d+)\.bin", self.path.split("?")[0])
+        return int(m.group(1)) if m else None
+
+    def __headers(self, status, length, extra=()):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes" if self.ranges else "none")
+        self.send_header("ETag", f'"{self.__size()}"')
+        for key, value in extra:
+            self.send_header(key, value)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.__respond(body=False)
+
+    def do_GET(self):
+        self.__respond(body=True)
+
+    def __respond(self, body):
+        faults = self.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        size = self.__size()
+        if size is None:
+            self.send_error(404)
+            return
+        if body and faults.roll(faults.error):
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        ranges = self.__ranges(size)
+        if ranges is None:
+            self.__headers(200, size)
+            if body:
+                self.__send(0, size)
+            return
+        if not ranges:
+            self.__headers(416, 0, [("Content-Range", f"bytes */{size}")])
+            return
+        if len(ranges) == 1 or not self.multipart:
+            start, end = ranges[0]
+            self.__headers(206, end - start + 1, [("Content-Range", f"bytes {start}-{end}/{size}")])
+            if body:
+                self.__send(start, end + 1)
+            return
+        # multipart/byteranges：每段一个小头，长度事先算好
+        heads = [(f"\r\n--{self.BOUNDARY}\r\nContent-Type: application/octet-stream\r\n"
+                  f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode() for start, end in ranges]
+        tail = f"\r\n--{self.BOUNDARY}--\r\n".encode()
+        length = sum(len(h) for h in heads) + sum(end - start + 1 for start, end in ranges) + len(tail)
+        self.__headers(206, length, [("Content-Type", f"multipart/byteranges; boundary={self.BOUNDARY}")])
+        if body:
+            for head, (start, end) in zip(heads, ranges):
+                self.wfile.write(head)
+                if not self.__send(start, end + 1):
+                    return
+            self.wfile.write(tail)
+
+    def __ranges(self, size):
+        """解析 Range 头：没有（或看不懂）返回 None，都不可满足返回 []"""
+        value = self.headers.get("Range", "").strip().lower()
+        if not self.ranges or not value.startswith("bytes="):
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range != f'"{size}"':  # 文件“变了”，按规定回整个文件
+            return None
+        ranges = []
+        for spec in value[len("bytes="):].split(","):
+            m = re.fullmatch(r"(\d*)-(\d*)", spec.strip())
+            if not m or not (m.group(1) or m.group(2)):
+                return None
+            if m.group(1):
+                start = int(m.group(1))
+                end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            else:
+                start, end = max(size - int(m.group(2)), 0), size - 1
+            if start <= end:
+                ranges.append((start, end))
+        return ranges
+
+    def __send(self, start, stop):
+        """发送 [start, stop)，连接断了返回 False"""
+        faults = self.faults
+        stall_at = start + faults.stall_point(stop - start) if faults.roll(faults.stall) else None
+        began, sent = time.time(), 0
+        offset = start
+        while offset < stop:
+            if stall_at is not None and offset >= stall_at:
+                stall_at = None
+                if not faults.stall_seconds:
+                    self.close_connection = True
+                    time.sleep(3600)  # 客户端断开后线程一直睡着也无妨，都是 daemon
+                    return False
+                time.sleep(faults.stall_seconds)
+            n = min(PIECE, stop - offset)
+            try:
+                self.wfile.write(content(offset, n))
+            except OSError:
+                self.close_connection = True
+                return False
+            offset += n
+            sent += n
+            if faults.rate:
+                ahead = sent / faults.rate - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+        return True
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # 客户端 help/retire 时直接断开连接是常事，不打印
+
+
+def start(port=0, multipart=True, ranges=True, **faults):
+    """在后台线程里起一个服务器，返回 (server, 根 URL)。faults 见 Faults"""
+    handler = type("Handler", (RangeHandler,), {"faults": Faults(**faults), "multipart": multipart, "ranges": ranges})
+    server = Server(("127.0.0.1", port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def add_fault_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.0, help="响应头之前的延迟（秒）")
+    parser.add_argument("--rate", type=int, default=0, help="每条连接的限速（字节/秒），0 不限")
+    parser.add_argument("--stall", type=float, default=0.0, help="响应中途卡住的概率")
+    parser.add_argument("--stall-seconds", type=float, default=0.0, help="卡多久，0 表示卡到客户端断开")
+    parser.add_argument("--error", type=float, default=0.0, help="回 503 的概率")
+    parser.add_argument("--seed", type=int, default=None, help="注入毛病用的随机数种子")
+
+
+def faults_from_args(args):
+    return dict(latency=args.latency, rate=args.rate, stall=args.stall, stall_seconds=args.stall_seconds,
+                error=args.error, seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=37213)
+    parser.add_argument("--no-multipart", action="store_true", help="好几段 Range 时只回第一段")
+    parser.add_argument("--no-ranges", action="store_true", help="不理会 Range，总是回 200")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+    server, url = start(args.port, multipart=not args.no_multipart, ranges=not args.no_ranges,
+                        **faults_from_args(args))
+    print(f"serving {url}/<size>.bin")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()